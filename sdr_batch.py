@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:40:05 2026
+
+@author: rzchlab
+
+Batch reanalysis of stacks of raw captures, e.g. an IQ recording of a
+whole sweep or scan (see SdrInterface.start_recording). The FFT, peak
+search and ratio -> d33 conversion run on a whole chunk of captures at a
+time instead of once per point through SdrInterface.get_spectrum:
+
+    df = reprocess('scan.iq', max_order=3, n_averages=4)
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import numpy as np
+import scipy.fft
+from sdr_interface import (SdrInterface, ReplaySdrInterface,
+                           get_transform_engine, interpolate_peaks)
+from sdr_measurements import peak_columns
+from sdr_storage import open_iq, read_iq_index
+
+# Capture metadata that isn't a measurement coordinate
+SETTINGS = ('offset', 'n_samples', 'time', 'center_freq', 'sample_freq',
+            'modulation_freq', 'ppk_voltage', 'gain_level', 'background')
+
+
+class BatchAnalysis(object):
+    def __init__(self, sdr, chunk_bytes=2**28):
+        """
+        Analyse stacks of captures with the analysis settings of sdr
+        (sample_freq, modulation_freq, ppk_voltage, max_order, peak_width,
+        peak estimation, averaging and fft options), giving the same numbers as
+        sdr.analyse_captures point by point.
+
+        Args:
+            sdr (SdrInterface): settings to copy. Only plain settings are
+                kept, so the BatchAnalysis can be sent to other processes.
+            chunk_bytes (int): rough bound on the FFT work memory per chunk
+        """
+        # Captures come decimated, if sdr decimates
+        self.sdr = SdrInterface(sdr.center_freq, sdr.analysis_freq(),
+                                sdr.n_samples // sdr.decimation,
+                                sdr.modulation_freq, sdr.ppk_voltage,
+                                sdr.max_order)
+        self.sdr.peak_width = sdr.peak_width
+        self.sdr.set_peak_estimation(sdr.peak_estimation)
+        self.sdr.set_averaging(sdr.n_averages, sdr.average_mode)
+        self.sdr.set_fft_options(sdr.fft_workers, sdr.fft_dtype)
+        self.chunk_bytes = chunk_bytes
+
+    def columns(self):
+        """Result columns, as in BiasSweep and LineScan."""
+        return ['d33', 'speed', 'disp'] + peak_columns(self.sdr.max_order)
+
+    def captures_per_point(self):
+        """Captures that make up one measurement point."""
+        if self.sdr.average_mode == 'captures':
+            return self.sdr.n_averages
+        return 1
+
+    def points_per_chunk(self, n_samples):
+        """Points analysed together, so the FFT work stays in chunk_bytes."""
+        point_bytes = (self.captures_per_point() * n_samples
+                       * self.sdr.fft_dtype.itemsize * 2)
+        return max(1, int(self.chunk_bytes // point_bytes))
+
+    def analyse(self, captures):
+        """
+        Analyse a stack of captures, captures_per_point consecutive rows per
+        point.
+
+        Args:
+            captures (array): shape (n_captures, n_samples)
+
+        Returns array of shape (n_points, len(columns())).
+        """
+        sdr = self.sdr
+        n_captures, n_samples = np.shape(captures)
+        if sdr.average_mode == 'segments':
+            # Each capture is one point of n_averages shorter segments
+            n_per_point = sdr.n_averages
+            n_samples //= n_per_point
+        else:
+            n_per_point = self.captures_per_point()
+        stack = np.reshape(captures, (-1, n_per_point, n_samples))
+        engine = get_transform_engine(n_samples, sdr.sample_freq,
+                                      sdr.fft_dtype)
+        windowed = np.multiply(stack, engine.window, dtype=engine.dtype)
+        spectra = scipy.fft.fft(windowed, axis=-1, overwrite_x=True,
+                                workers=sdr.fft_workers)
+        if not engine.shifted:
+            spectra = np.roll(spectra, n_samples//2, axis=-1)
+
+        # Only the windows around each harmonic are needed from here on
+        orders = np.arange(-sdr.max_order, sdr.max_order + 1)
+        centers = np.argmin(np.abs(engine.freqs[None, :]
+                                   - (orders * sdr.modulation_freq)[:, None]),
+                            axis=1)
+        # The search windows plus a bin either side for the interpolation
+        windows = (centers[:, None]
+                   + np.arange(-sdr.peak_width - 1, sdr.peak_width + 1))
+        # (points, captures, orders, bins)
+        magnitude = np.abs(spectra[..., windows])
+        del spectra, windowed
+
+        # Per capture ratios, for the statistics
+        ratio_samples = self.ratios(self.peak_heights(magnitude))
+        if n_per_point > 1:
+            magnitude = magnitude.mean(axis=1)
+        else:
+            magnitude = magnitude[:, 0]
+        ratios = self.ratios(self.peak_heights(magnitude))
+        speed = sdr.speed_from_ratios(ratios)
+        displacement = sdr.displacement_from_speed(speed)
+        total_d33, _ = sdr.d33_from_displacement(displacement)
+
+        d33_samples, _ = sdr.d33_from_displacement(
+                sdr.displacement_from_speed(
+                        sdr.speed_from_ratios(ratio_samples)))
+        if n_per_point > 1:
+            root_n = np.sqrt(n_per_point)
+            d33_sem = np.std(d33_samples, axis=1, ddof=1) / root_n
+            ratios_sem = np.std(ratio_samples, axis=1, ddof=1) / root_n
+        else:
+            d33_sem = np.full(len(ratios), np.nan)
+            ratios_sem = np.full(ratios.shape, np.nan)
+        return np.column_stack((total_d33, speed[:, 0], displacement[:, 0],
+                                ratios, d33_sem, ratios_sem))
+
+    def peak_heights(self, magnitude):
+        """Height of the peak in each search window (the last axis, with an
+        extra bin either side), see SdrInterface.peak_heights."""
+        if self.sdr.peak_estimation == 'bin':
+            return magnitude[..., 1:-1].max(axis=-1)
+        i = 1 + np.argmax(magnitude[..., 1:-1], axis=-1)[..., None]
+        left, center, right = (
+                np.take_along_axis(magnitude, i + j, axis=-1)[..., 0]
+                for j in (-1, 0, 1))
+        return interpolate_peaks(left, center, right)[1]
+
+    def ratios(self, peak_heights):
+        """
+        Peak ratios averaged over +- order, from the peak heights of each
+        order (-max_order..max_order along the last axis).
+        """
+        max_order = self.sdr.max_order
+        peak0 = peak_heights[..., max_order, None]
+        posneg = (peak_heights[..., max_order + 1:]
+                  + peak_heights[..., max_order - 1::-1]) / 2
+        return posneg / peak0
+
+    def run(self, captures, points=None, n_processes=None):
+        """
+        Analyse a stack of captures chunk by chunk.
+
+        Args:
+            captures (array): shape (n_captures, n_samples), e.g. a memmap
+            points (DataFrame): coordinates of each point (bias_v, loc_um,
+                ...), put before the results
+            n_processes (int): spread the chunks over this many processes
+                (None to analyse them here, with the fft workers threads)
+
+        Returns DataFrame with a row per point.
+        """
+        n_captures, n_samples = np.shape(captures)
+        step = self.points_per_chunk(n_samples) * self.captures_per_point()
+        chunks = (captures[i:i + step] for i in range(0, n_captures, step))
+        return self._collect(chunks, points, n_processes)
+
+    def run_recording(self, path, n_processes=None):
+        """
+        Analyse an IQ recording (see sdr_storage.IqRecorder), skipping
+        background captures. The capture tags of each point become the
+        leading columns.
+
+        Returns DataFrame with a row per point.
+        """
+        import pandas as pd
+        index = [info for info in read_iq_index(path)
+                 if not info.get('background')]
+        self.check_recording(index)
+        n_per_point = self.captures_per_point()
+        tags = [k for k in index[0] if k not in SETTINGS]
+        points = pd.DataFrame([[info.get(k, np.nan) for k in tags]
+                               for info in index[::n_per_point]],
+                              columns=tags)
+        offsets = np.array([info['offset'] for info in index])
+        n_samples = index[0]['n_samples']
+        step = self.points_per_chunk(n_samples) * n_per_point
+        chunks = [offsets[i:i + step] for i in range(0, len(offsets), step)]
+        if n_processes is None:
+            iq = open_iq(path)
+            chunks = (read_captures(iq, chunk, n_samples) for chunk in chunks)
+            return self._collect(chunks, points)
+        # Each process maps the recording itself, so the samples aren't
+        # pickled across
+        worker = self.for_processes()
+        with ProcessPoolExecutor(n_processes) as pool:
+            results = pool.map(_analyse_recording_chunk,
+                               [worker] * len(chunks), [path] * len(chunks),
+                               chunks, [n_samples] * len(chunks))
+            return self.to_dataframe(list(results), points)
+
+    def check_recording(self, index):
+        """Raise ValueError unless every capture was taken with these
+        settings and the captures make whole points."""
+        sdr = self.sdr
+        for info in index:
+            if (info['n_samples'] != index[0]['n_samples']
+                    or info['sample_freq'] != sdr.sample_freq
+                    or info['modulation_freq'] != sdr.modulation_freq
+                    or info['ppk_voltage'] != sdr.ppk_voltage):
+                raise ValueError('Capture at %d has different settings'
+                                 % info['offset'])
+        if len(index) % self.captures_per_point():
+            raise ValueError('%d captures is not a whole number of points'
+                             % len(index))
+
+    def for_processes(self):
+        """Copy to send to worker processes, with one fft thread each."""
+        worker = copy.deepcopy(self)
+        worker.sdr.set_fft_options(1, self.sdr.fft_dtype)
+        return worker
+
+    def _collect(self, chunks, points=None, n_processes=None):
+        """Analyse chunks of captures and stack the results."""
+        if n_processes is None:
+            return self.to_dataframe([self.analyse(c) for c in chunks],
+                                     points)
+        worker = self.for_processes()
+        with ProcessPoolExecutor(n_processes) as pool:
+            futures = [pool.submit(worker.analyse, np.asarray(c))
+                       for c in chunks]
+            return self.to_dataframe([f.result() for f in futures], points)
+
+    def to_dataframe(self, results, points=None):
+        """DataFrame of the stacked chunk results, after the points."""
+        import pandas as pd
+        df = pd.DataFrame(np.concatenate(results), columns=self.columns())
+        if points is None:
+            return df
+        return pd.concat([points.reset_index(drop=True), df], axis=1)
+
+
+def read_captures(iq, offsets, n_samples):
+    """
+    Captures starting at offsets in a recording's memmap, as a 2D array.
+    A view (nothing read yet) when they are back to back, as they are
+    unless background captures were interleaved.
+    """
+    start = offsets[0]
+    if np.array_equal(offsets, start + n_samples * np.arange(len(offsets))):
+        return iq[start:start + n_samples * len(offsets)].reshape(
+                len(offsets), n_samples)
+    return iq[offsets[:, None] + np.arange(n_samples)]
+
+
+def _analyse_recording_chunk(batch, path, offsets, n_samples):
+    """BatchAnalysis.analyse on captures of a recording, in a worker
+    process."""
+    return batch.analyse(read_captures(open_iq(path), offsets, n_samples))
+
+
+def reprocess(path, max_order, n_averages=1, average_mode='captures',
+              peak_width=None, peak_estimation='interpolated',
+              n_processes=None, chunk_bytes=2**28):
+    """
+    Reanalyse an IQ recording with new analysis settings.
+
+    Args:
+        path (str): recording directory
+        max_order (int): highest harmonic to analyse
+        n_averages, average_mode: how the points were averaged, see
+            SdrInterface.set_averaging
+        peak_width (int): peak search half width, default
+            SdrInterface.peak_width
+        peak_estimation (str): see SdrInterface.set_peak_estimation
+        n_processes (int): analyse chunks in this many processes
+        chunk_bytes (int): rough bound on the FFT work memory per chunk
+
+    Returns DataFrame with a row per point, like the measurement's data.
+    """
+    replay = ReplaySdrInterface(path, max_order)
+    replay.set_averaging(n_averages, average_mode)
+    replay.set_peak_estimation(peak_estimation)
+    if peak_width is not None:
+        replay.peak_width = peak_width
+    batch = BatchAnalysis(replay, chunk_bytes)
+    return batch.run_recording(path, n_processes)
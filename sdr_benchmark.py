@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:12:40 2026
+
+@author: rzchlab
+
+Benchmarks for the spectrum -> d33 pipeline, run on SimulatedSdrInterface
+so no hardware is needed. Writes JSON so runs from different versions can
+be compared:
+
+    python sdr_benchmark.py -o new.json
+    python sdr_benchmark.py --compare old.json new.json
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import scipy
+
+from sdr_interface import SimulatedSdrInterface, SpectrumAnalysis
+from sdr_measurements import BiasSweep
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_bytes():
+    """
+    Peak resident set size of this process so far, or None if unknown. 
+    It is the high water mark of the whole run, not of any one stage (see
+    alloc_peak_bytes of each stage for that).
+    """
+    if resource is None:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().peak_wset
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on linux, bytes on mac
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def time_stage(func, repeats):
+    """
+    Run func repeats times, then once more under tracemalloc.
+
+    Returns dict of median and min wall time (s) and the peak bytes
+    allocated during that last run alone (tracemalloc is started afresh
+    for each stage).
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    _, alloc_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dict(median_s=float(np.median(times)), min_s=float(np.min(times)),
+                repeats=repeats, alloc_peak_bytes=alloc_peak)
+
+
+def uncached(sdr, func):
+    """
+    func, after dropping the SpectrumAnalysis sdr memoized for its
+    spectrum, so it times the analysis like the first call after 
+    get_spectrum does (the peaks found with the spectrum are reused, as 
+    there).
+    """
+    def run():
+        sdr._analysis = None
+        return func()
+    return run
+
+
+def bench_pipeline(n_samples, max_order, analysis_mode='full', repeats=5):
+    """
+    Time each stage of get_spectrum -> d33 on one simulated capture.
+
+    Returns list of result dicts, one per stage.
+    """
+    sdr = SimulatedSdrInterface(40e6, 2.048e6, n_samples, 30e3, 1, max_order,
+                                harmonics=[1e-11] * (max_order - 1), seed=0,
+                                analysis_mode=analysis_mode)
+    full = analysis_mode == 'full'
+    sdr.get_spectrum()
+    key = sdr.analysis_key()
+    peaks = sdr.find_peaks()
+    stages = [
+        ('get_samples', sdr.get_samples),
+        ('compute_spectrum', lambda: sdr.compute_spectrum(full=full)),
+        # peak_indices and SpectrumAnalysis bypass the per-spectrum cache
+        ('find_peaks', lambda: sdr.peak_indices(sdr.freqs, sdr.magnitude,
+                                                sdr.peak_width)),
+        ('analysis', lambda: SpectrumAnalysis(sdr, key, peaks)),
+        # Otherwise just a lookup of the analysis get_spectrum memoized
+        ('peak_ratios', uncached(sdr, sdr.peak_ratios)),
+        ('get_d33', uncached(sdr, sdr.get_d33)),
+        ('get_spectrum_to_d33', lambda: (sdr.get_spectrum(),
+                                         sdr.get_d33_spe_disp(),
+                                         sdr.peak_ratios())),
+    ]
+    results = []
+    for stage, func in stages:
+        result = dict(case='pipeline', stage=stage, n_samples=n_samples,
+                      max_order=max_order, analysis_mode=analysis_mode)
+        result.update(time_stage(func, repeats))
+        results.append(result)
+    return results
+
+
+def bench_bias_sweep(n_samples, max_order, nstep=5, analysis_mode='full'):
+    """
+    Time a full BiasSweep.run on the simulator with no real time pacing,
+    i.e. everything but the hardware wait.
+    """
+    class FuncGenMock(object):
+        def offset(self, offset_v):
+            pass
+    sdr = SimulatedSdrInterface(40e6, 2.048e6, n_samples, 30e3, 1, max_order,
+                                seed=0, analysis_mode=analysis_mode)
+    biassweep = BiasSweep(sdr, FuncGenMock())
+    points = biassweep.triwave(1, nstep)
+    result = dict(case='bias_sweep', stage='run', n_samples=n_samples,
+                  max_order=max_order, analysis_mode=analysis_mode,
+                  n_points=len(points))
+    result.update(time_stage(lambda: biassweep.run(points), repeats=1))
+    result['per_point_s'] = result['median_s'] / len(points)
+    return result
+
+
+def run_all(log2_samples, max_orders, analysis_modes, repeats):
+    """
+    Run every benchmark. Returns dict of metadata and results. The meta
+    run_peak_rss_bytes is the high water mark of the whole run, the memory
+    of each stage is its alloc_peak_bytes.
+    """
+    results = []
+    for analysis_mode in analysis_modes:
+        for log2_n in log2_samples:
+            for max_order in max_orders:
+                print(f'{analysis_mode} 2^{log2_n} max_order={max_order}',
+                      file=sys.stderr)
+                results += bench_pipeline(2**log2_n, max_order,
+                                          analysis_mode, repeats)
+        results.append(bench_bias_sweep(2**min(log2_samples),
+                                        max(max_orders),
+                                        analysis_mode=analysis_mode))
+    return dict(
+            meta=dict(time=time.strftime('%Y-%m-%d %H:%M:%S'),
+                      python=platform.python_version(),
+                      numpy=np.__version__, scipy=scipy.__version__,
+                      machine=platform.machine(),
+                      run_peak_rss_bytes=peak_rss_bytes()),
+            results=results)
+
+
+def result_key(result):
+    """Identifies the same benchmark across runs."""
+    return (result['case'], result['stage'], result['n_samples'],
+            result['max_order'], result['analysis_mode'])
+
+
+def compare(old, new):
+    """Print new/old median time ratio for every benchmark in both runs."""
+    old_results = {result_key(r): r for r in old['results']}
+    for result in new['results']:
+        if result_key(result) not in old_results:
+            continue
+        old_result = old_results[result_key(result)]
+        ratio = result['median_s'] / old_result['median_s']
+        flag = '  <-- slower' if ratio > 1.2 else ''
+        print('{:10s} {:20s} 2^{:<3.0f} order {} {:8s} {:6.2f}x{}'.format(
+                result['case'], result['stage'], np.log2(result['n_samples']),
+                result['max_order'], result['analysis_mode'], ratio, flag))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[-1])
+    parser.add_argument('-o', '--output', help='JSON file for the results')
+    parser.add_argument('--log2-samples', type=int, nargs='+',
+                        default=list(range(17, 24, 2)),
+                        help='capture sizes as powers of 2 (GUI allows 17-23)')
+    parser.add_argument('--max-orders', type=int, nargs='+', default=[1, 3])
+    parser.add_argument('--modes', nargs='+', default=['full', 'harmonic'])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files instead of running')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f_old, open(args.compare[1]) as f_new:
+            compare(json.load(f_old), json.load(f_new))
+    else:
+        run = run_all(args.log2_samples, args.max_orders, args.modes,
+                      args.repeats)
+        text = json.dumps(run, indent=1)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(text)
+        else:
+            print(text)
@@ -6,28 +6,54 @@ Created on Thu Oct  3 13:53:01 2019
 """
 
 from rzcheasygui import Dialog
-import pandas as pd
+import numpy as np
 from tkinter.filedialog import asksaveasfilename
-import pickle
+from tkinter.messagebox import showinfo
+import os
+import shutil
+import tempfile
+import time
+from sdr_live import LiveSpectrum
+from sdr_measurements import MeasurementRunner
+from sdr_storage import save_results
+from sdr_timing import save_timing_report
 
 class SdrGUI():
-    def __init__(self, sdr, fg, mc, lia, linescan, biassweep, biassweepcv):
+    def __init__(self, sdr, fg, mc, lia, linescan, biassweep, biassweepcv,
+                 areascan=None, instruments=None, freqsweep=None):
         """
         Main GUI object.
         Args:
             sdr: SdrInterface instance
             fg: function generator instance from instrpyvisa
             mc: motion control instance from instrpyvisa
+            areascan: AreaScan instance (no Area Scan tab if None)
+            instruments: InstrumentRegistry the instruments are connecting
+                from (see sdr_instruments), to show their status
+            freqsweep: FrequencySweep instance (no Freq Sweep tab if None)
         """
         self.sdr = sdr
+        self.instruments = instruments
         self.fg = fg
         self.mc = mc
         self.lia = lia
         self.linescan = linescan
         self.biassweep = biassweep
         self.biassweepcv = biassweepcv
+        self.areascan = areascan
+        self.freqsweep = freqsweep
         self.dmain = Dialog(title="SDR")
         self.PEAK_WIDTH_SEARCH = 100
+        # Measurements run on a worker thread, see run_measurement
+        self.runner = MeasurementRunner()
+        self.live_rows = []
+        # Continuous spectrum on the SDR tab, see start_live
+        self.live = LiveSpectrum(sdr)
+        self.live_timer = None
+        self.live_artists = []
+        # SDR tab settings waiting for the sdr to connect, see 
+        # update_sdr_params
+        self.sdr_params_pending = False
 
         # SDR tab
         # --------------------
@@ -45,18 +71,31 @@ class SdrGUI():
         self.tsdr.ppk_voltage.disable()
         self.tsdr.max_order = self.tsdr.integerbox('Max order', 1)
         self.tsdr.gain_level = self.tsdr.integerbox('Gain Level', 5)
+        self.tsdr.decimate = self.tsdr.checkbox('Decimate', 0)
+        self.tsdr.target_snr = self.tsdr.floatbox('Target SNR (0 = off)', 0)
 
         self.tsdr.labelbox('')
         self.tsdr.button('Get Spectrum', self.get_spectrum)
         self.tsdr.button('Collect Background', self.get_bg_spectrum)
         self.tsdr.show_bg = self.tsdr.checkbox('Show Background', 0)
+        self.tsdr.record_iq = self.tsdr.checkbox('Record raw IQ', 0)
+        self.tsdr.button('Start/Stop Live', self.toggle_live)
+        self.tsdr.live_fps = self.tsdr.floatbox('Live frame rate (Hz)', 10)
 
-        self.tsdr.graph = self.tsdr.graph()
+        # Spectrum, and the live waterfall below it
+        self.tsdr.graph = self.tsdr.graph((2, 1))
 
         self.tsdr.labelbox('LDV Output')
         self.tsdr.lbl_ldv_d33 = self.tsdr.labelbox('d33: 0.0 pm/V')
         self.tsdr.lbl_peak_ratios = self.tsdr.labelbox('peak ratios: ')
         self.tsdr.lbl_phase_check = self.tsdr.labelbox('phase check: ')
+        self.tsdr.lbl_snr = self.tsdr.labelbox('SNR: ')
+        if instruments is not None:
+            self.tsdr.lbl_instruments = self.tsdr.labelbox('Instruments: ')
+            self.status_timer = self.tsdr.graph.ax[0].figure.canvas.new_timer(
+                    interval=500)
+            self.status_timer.add_callback(self.update_instrument_status)
+            self.status_timer.start()
 
 
         # FuncGen tab
@@ -72,8 +111,11 @@ class SdrGUI():
         self.tfg.output_on = self.tfg.button('Config Sin', self.fg_setup_sin)
 
         self.tfg.labelbox('Output')
-        self.tfg.output_on = self.tfg.button('On', fg.outp_on)
-        self.tfg.output_off = self.tfg.button('Off', fg.outp_off)
+        # Looked up on click, fg may still be connecting
+        self.tfg.output_on = self.tfg.button(
+                'On', lambda: self.fg_output(True))
+        self.tfg.output_off = self.tfg.button(
+                'Off', lambda: self.fg_output(False))
 
         # Motion Control tab
         # --------------------
@@ -99,9 +141,11 @@ class SdrGUI():
         self.tls.labelbox('(y-axis is 1, x-axis is 2)')
         self.tls.labelbox('+ is to the right (axis=1) and up (axis=2)')
         self.tls.labelbox('Must reconfigure FG after running PE!')
+        self.tls.pipelined = self.tls.checkbox('Pipelined', 0)
         self.tls.button('Run Linescan', self.go_linescan)        
+        self.tls.button('Abort', self.runner.abort)
         self.tls.button(
-                'Save Line Scan', lambda: self.go_save(self.linescan.data))
+                'Save Line Scan', lambda: self.go_save(self.linescan))
         self.tls.rb_labels = ['d33', 'speed', 'disp']
         self.tls.graph = self.tls.graph()
         cb = lambda: self.update_ls_plot(self.tls.graph)
@@ -117,8 +161,9 @@ class SdrGUI():
         self.tbs.labelbox('1 Seg = 1/4 wave')
         self.tls.labelbox('Must reconfigure FG after running PE!')
         self.tbs.button('Run Bias Sweep', self.go_biassweep)
+        self.tbs.button('Abort', self.runner.abort)
         self.tbs.button(
-                'Save Bias Sweep', lambda: self.go_save(self.biassweep.data))
+                'Save Bias Sweep', lambda: self.go_save(self.biassweep))
         self.tbs.rb_labels = ['d33', 'speed', 'disp']
         self.tbs.graph = self.tbs.graph()
         cb = lambda: self.update_bs_plot(self.tbs.graph)
@@ -134,47 +179,264 @@ class SdrGUI():
         self.tbscv.labelbox('1 Seg = 1/4 wave')
         self.tbscv.labelbox('Must reconfigure FG after running PE!')
         self.tbscv.button('Run Bias Sweep', self.go_biassweepcv)
+        self.tbscv.button('Abort', self.runner.abort)
         self.tbscv.button(
-                'Save Bias Sweep', lambda: self.go_save(self.biassweepcv.data))
+                'Save Bias Sweep', lambda: self.go_save(self.biassweepcv))
         self.tbscv.rb_labels = ['d33', 'speed', 'disp']
         self.tbscv.graph = self.tbscv.graph((2, 1))
         self.tbscv.rb = self.tbscv.radiobuttons(
                 'Plot:', self.tbscv.rb_labels, 0, 
                 callback=self.update_bscv_plot)
 
+        # Area scan tab
+        # --------------------
+        if self.areascan is not None:
+            self.tas = self.dmain.tab('AreaScan')
+            self.tas.labelbox('Parameters')
+            self.tas.step_x_um = self.tas.floatbox('Step x (um)', 10)
+            self.tas.step_y_um = self.tas.floatbox('Step y (um)', 10)
+            self.tas.nsteps_x = self.tas.integerbox('N Steps x', 10)
+            self.tas.nsteps_y = self.tas.integerbox('N Steps y', 10)
+            self.tas.labelbox('Serpentine raster, x (axis 2) is fast')
+            self.tas.pipelined = self.tas.checkbox('Pipelined', 1)
+            self.tas.button('Run Area Scan', self.go_areascan)
+            self.tas.button('Abort', self.runner.abort)
+            self.tas.button(
+                    'Save Area Scan', lambda: self.go_save(self.areascan))
+            self.tas.rb_labels = ['d33', 'speed', 'disp']
+            self.tas.graph = self.tas.graph()
+            self.tas.rb = self.tas.radiobuttons(
+                    'Plot:', self.tas.rb_labels, 0, 
+                    callback=self.update_as_plot)
+
+        # Frequency sweep tab
+        # --------------------
+        if self.freqsweep is not None:
+            self.tfs = self.dmain.tab('Freq Sweep')
+            self.tfs.labelbox('Parameters')
+            self.tfs.start_khz = self.tfs.floatbox('Start (kHz)', 10)
+            self.tfs.stop_khz = self.tfs.floatbox('Stop (kHz)', 100)
+            self.tfs.npoints = self.tfs.integerbox('N Points', 10)
+            self.tfs.multitone = self.tfs.checkbox('Multi-tone', 0)
+            self.tfs.labelbox('Vpp and offset from the FuncGen tab')
+            self.tfs.labelbox('Multi-tone needs an arb capable FG')
+            self.tfs.button('Run Freq Sweep', self.go_freqsweep)
+            self.tfs.button('Abort', self.runner.abort)
+            self.tfs.button(
+                    'Save Freq Sweep', lambda: self.go_save(self.freqsweep))
+            self.tfs.rb_labels = ['d33', 'speed', 'disp']
+            self.tfs.graph = self.tfs.graph()
+            cb = lambda: self.update_fs_plot(self.tfs.graph)
+            self.tfs.rb = self.tfs.radiobuttons(
+                    'Plot:', self.tfs.rb_labels, 0, callback=cb)
+
+    def update_instrument_status(self):
+        """
+        Timer callback: show the connection status of each instrument. 
+        Returns False (stopping the timer) once none is still connecting.
+        """
+        status = self.instruments.status()
+        self.tsdr.lbl_instruments.set('Instruments: ' + ', '.join(
+                '%s %s' % item for item in status.items()))
+        if self.sdr_params_pending and status.get('sdr') == 'connected':
+            self.update_sdr_params()
+        return 'connecting' in status.values()
+
+    def connected(self, *names):
+        """
+        Whether the instruments names are all connected, without waiting
+        for them: controls on the Tk loop must not block on (or raise 
+        from) a connection in progress or failed. Always True without an
+        InstrumentRegistry.
+        """
+        if self.instruments is None:
+            return True
+        status = self.instruments.status()
+        return all(status.get(name) == 'connected' for name in names)
+
+    def busy(self, sdr=True):
+        """
+        True if a measurement is running, or (if sdr) the live view is
+        using the sdr. Controls that would change the instruments under a
+        run do nothing then.
+        """
+        return self.runner.running() or (sdr and self.live.running)
+
     def get_bg_spectrum(self):
-        self.sdr.set_center_freq(int(self.tsdr.center_freq_Mhz.get() * 1e6))
-        self.sdr.set_sample_freq(int(self.tsdr.sample_freq_Mhz.get() * 1e6))
-        self.sdr.set_n_samples(2**self.tsdr.n_samples_log2.get())
+        if self.busy() or not self.connected('sdr'):
+            return
+        self.sdr.configure(
+                center_freq=int(self.tsdr.center_freq_Mhz.get() * 1e6),
+                sample_freq=int(self.tsdr.sample_freq_Mhz.get() * 1e6),
+                n_samples=2**self.tsdr.n_samples_log2.get())
         self.sdr.get_bg_spectrum()
         
     def update_sdr_params(self):
-        self.sdr.set_modulation_freq(int(self.tsdr.modulation_freq.get() * 1e3))
-        self.sdr.set_center_freq(int(self.tsdr.center_freq_Mhz.get() * 1e6))
-        self.sdr.set_sample_freq(int(self.tsdr.sample_freq_Mhz.get() * 1e6))
-        self.sdr.set_n_samples(2**self.tsdr.n_samples_log2.get())
-        self.sdr.set_voltage(self.tsdr.ppk_voltage.get())
-        self.sdr.set_max_order(self.tsdr.max_order.get())
-        self.sdr.set_gain_level(self.tsdr.gain_level.get())
+        """Send the SDR tab settings to the sdr, writing only the ones 
+        that changed (see SdrInterface.configure). Until the sdr is 
+        connected they are only marked pending, and sent by 
+        update_instrument_status once it is. Returns the ConfigChange, 
+        None if pending."""
+        if not self.connected('sdr'):
+            self.sdr_params_pending = True
+            return None
+        self.sdr_params_pending = False
+        target_snr = self.tsdr.target_snr.get()
+        return self.sdr.configure(
+                modulation_freq=int(self.tsdr.modulation_freq.get() * 1e3),
+                center_freq=int(self.tsdr.center_freq_Mhz.get() * 1e6),
+                sample_freq=int(self.tsdr.sample_freq_Mhz.get() * 1e6),
+                n_samples=2**self.tsdr.n_samples_log2.get(),
+                ppk_voltage=self.tsdr.ppk_voltage.get(),
+                max_order=self.tsdr.max_order.get(),
+                gain_level=self.tsdr.gain_level.get(),
+                # As far as the harmonics up to max order allow
+                decimation='auto' if self.tsdr.decimate.get() else 1,
+                # Samples 2^ is then the most taken per capture
+                target_snr=target_snr if target_snr > 0 else None)
 
     def get_spectrum(self):
+        if self.busy() or not self.connected('sdr'):
+            return
         self.update_sdr_params()
+        self.clear_live()
         ax = self.tsdr.graph.ax[0]
-        ax.cla()
         self.sdr.get_spectrum()
+        # Reuses the lines already on ax
         self.sdr.plot_spectrum(ax, show_bg = self.tsdr.show_bg.get())
-        ax.figure.canvas.draw()
+        ax.figure.canvas.draw_idle()
         d33, _ = self.sdr.get_d33()
-        s = 'peak ratios (ppm): ' + '{:.0f}  ' * self.tsdr.max_order.get()
-        peakratios = self.sdr.peak_ratios() * 1e6
-        self.tsdr.lbl_peak_ratios.set(s.format(*peakratios))
-        self.tsdr.lbl_ldv_d33.set(f'd33: {1e12*d33:.1f} pm/V')
+        self.set_ldv_labels(self.sdr.peak_ratios(), d33)
         
         check_phase = self.sdr.check_phase()
         self.tsdr.lbl_phase_check.set(f'phase check: {check_phase[1]}')
+        snr = np.min(self.sdr.check_point(), axis=1)
+        s = 'SNR: ' + '{:.0f}  ' * len(snr)
+        self.tsdr.lbl_snr.set(s.format(*snr))
+
+    def set_ldv_labels(self, peak_ratios, d33):
+        s = 'peak ratios (ppm): ' + '{:.0f}  ' * len(peak_ratios)
+        self.tsdr.lbl_peak_ratios.set(s.format(*(peak_ratios * 1e6)))
+        self.tsdr.lbl_ldv_d33.set(f'd33: {1e12*d33:.1f} pm/V')
+
+    def toggle_live(self):
+        if self.live.running:
+            self.stop_live()
+        else:
+            self.start_live()
+
+    def start_live(self):
+        """
+        Start the live view: spectra are taken back to back on a worker 
+        thread (see sdr_live.LiveSpectrum) and the averaged spectrum, the 
+        waterfall and the LDV labels are refreshed at the live frame rate.
+        The parameters are sent to the sdr once here, with a fixed capture
+        length (Target SNR is ignored until the next Get Spectrum).
+
+        Only the spectrum line and the waterfall image are redrawn each 
+        frame (blitting onto a saved background), the axes only when the 
+        spectrum leaves the y range.
+        """
+        if self.busy() or not self.connected('sdr'):
+            return
+        self.update_sdr_params()
+        self.sdr.set_adaptive(None)
+        ax, ax_wf = self.tsdr.graph.ax
+        canvas = ax.figure.canvas
+        ax.cla()
+        ax_wf.cla()
+        xlim = self.live.span()
+        line, = ax.plot([], [], 'g-', animated=True)
+        ax.set_xlim(xlim)
+        ax.set_xlabel('f (kHz)')
+        ax.set_ylabel('dB')
+        image = ax_wf.imshow(self.live.waterfall, aspect='auto', 
+                             origin='lower', interpolation='nearest',
+                             extent=(*xlim, 0, self.live.n_rows), 
+                             animated=True)
+        ax_wf.set_xlabel('f (kHz)')
+        ax_wf.set_ylabel('Spectrum (newest on top)')
+        self.live_artists = [line, image]
+        self._live_ylim = None
+        self._live_frames = 0
+        self._live_background = None
+        # Every full draw (first frame, rescale, window resize) saves the
+        # new background
+        self._live_cid = canvas.mpl_connect('draw_event', 
+                                            self._save_live_background)
+        self.live.start()
+        fps = max(self.tsdr.live_fps.get(), 0.1)
+        self.live_timer = canvas.new_timer(interval=int(1000 / fps))
+        self.live_timer.add_callback(self.draw_live)
+        self.live_timer.start()
+
+    def stop_live(self):
+        """Stop the live view, leaving the last frame on the plot."""
+        if self.live_timer is None:
+            return
+        self.live_timer.stop()
+        self.live_timer = None
+        self.live.stop()
+        canvas = self.tsdr.graph.ax[0].figure.canvas
+        canvas.mpl_disconnect(self._live_cid)
+        for artist in self.live_artists:
+            artist.set_animated(False)
+        canvas.draw_idle()
+
+    def clear_live(self):
+        """Remove the last live frame, if any, from the plots."""
+        for artist in self.live_artists:
+            artist.remove()
+        self.live_artists = []
+
+    def _save_live_background(self, event):
+        canvas = self.tsdr.graph.ax[0].figure.canvas
+        self._live_background = canvas.copy_from_bbox(canvas.figure.bbox)
+        self._blit_live()
+
+    def _blit_live(self):
+        line, image = self.live_artists
+        line.axes.draw_artist(line)
+        image.axes.draw_artist(image)
+        canvas = line.figure.canvas
+        canvas.blit(canvas.figure.bbox)
+
+    def draw_live(self):
+        """
+        Timer callback: draw the latest live frame. Returns False (stopping
+        the timer) once the live view has stopped, e.g. on an error.
+        """
+        if not self.live.running:
+            error = self.live.error
+            self.stop_live()
+            if error is not None:
+                raise error
+            return False
+        x, y, waterfall, ratios, d33, n_frames = self.live.snapshot()
+        if n_frames == self._live_frames:
+            return True
+        self._live_frames = n_frames
+        line, image = self.live_artists
+        line.set_data(x, y)
+        image.set_data(waterfall)
+        lo, hi = np.min(y), np.max(y)
+        ylim = self._live_ylim
+        if ylim is None or lo < ylim[0] or hi > ylim[1]:
+            # Rescale with some headroom, the draw saves a new background
+            self._live_ylim = (lo - 10, hi + 10)
+            line.axes.set_ylim(self._live_ylim)
+            image.set_clim(lo, hi)
+            line.figure.canvas.draw()
+        else:
+            line.figure.canvas.restore_region(self._live_background)
+            self._blit_live()
+        self.set_ldv_labels(ratios, d33)
+        return True
 
     def fg_setup_sin(self):
         """Wrapper for setting up sin output of fg"""
+        if self.busy() or not self.connected('fg', 'sdr'):
+            return
         vpp = self.tfg.vpp.get()/5
         freq = self.tfg.freq.get() * 1000
         offset = self.tfg.offset.get()/5
@@ -182,85 +444,252 @@ class SdrGUI():
         self.sdr.set_modulation_freq(freq)
         self.sdr.set_voltage(self.tfg.vpp.get())
 
+    def fg_output(self, on):
+        """Switch the fg output on or off."""
+        if self.busy(sdr=False) or not self.connected('fg'):
+            return
+        if on:
+            self.fg.outp_on()
+        else:
+            self.fg.outp_off()
+
     def mc_mover_um(self, axis, inv=False):
         sgn = -1 if inv else 1
-        return lambda: self.mc.move_um(axis, self.tmc.step_um.get() * sgn)
+        def move():
+            # The live view may keep running, e.g. to align the beam
+            if self.busy(sdr=False) or not self.connected('mc'):
+                return
+            self.mc.move_um(axis, self.tmc.step_um.get() * sgn)
+        return move
 
     def go_linescan(self):
-        self.linescan.run(
+        graph = self.tls.graph
+        self.run_measurement(
+                self.linescan, 'linescan',
+                lambda df: self.update_ls_plot(graph, df=df),
                 step_um=-self.tls.step_um.get(),
                 nsteps=self.tls.nsteps.get(),
-                moveaxis=self.tls.moveaxis.get())
-        self.update_ls_plot(self.tls.graph)
+                moveaxis=self.tls.moveaxis.get(),
+                pipelined=bool(self.tls.pipelined.get()))
         
-    def go_save(self, df):
+    def autosave_path(self, name):
+        """New temp directory to autosave a measurement run to."""
+        return os.path.join(tempfile.gettempdir(), 'sdr_autosave',
+                            name + time.strftime('_%Y%m%d_%H%M%S'))
+
+    def run_measurement(self, measurement, name, update, *args, **kwargs):
+        """
+        Start a measurement's run on the runner thread with a new autosave
+        directory, recording the raw IQ next to it (autosave + '_iq') if
+        Record raw IQ is on. Does nothing if one is already running.
+
+        The Tk loop polls for new points every 100 ms and calls update with
+        a DataFrame of the points so far, then with None (plot
+        measurement.data) once the run is over.
+        """
+        if self.busy(sdr=False) or not self.connected('sdr'):
+            return
+        self.stop_live()
+        autosave = self.autosave_path(name)
+        if self.tsdr.record_iq.get():
+            self.sdr.start_recording(autosave + '_iq')
+        self.live_rows = []
+        self.runner.start(measurement, *args, autosave=autosave, **kwargs)
+        self.poll_timer = self.tsdr.graph.ax[0].figure.canvas.new_timer(
+                interval=100)
+        self.poll_timer.add_callback(self.poll_measurement, update)
+        self.poll_timer.start()
+
+    def poll_measurement(self, update):
+        """
+        Timer callback: plot the new points. Returns False (stopping the 
+        timer) once the run is over.
+        """
+        new_points = False
+        for kind, value in self.runner.poll():
+            if kind == 'point':
+                # ResultTable rows are dicts, AreaScan posts (row, col)
+                if isinstance(value[0], dict):
+                    self.live_rows.append(value[0])
+                new_points = True
+                continue
+            self.sdr.stop_recording()
+            update(None)
+            self.show_timing(self.runner.measurement)
+            if kind == 'error':
+                raise value
+            return False
+        if new_points:
+            import pandas as pd
+            update(pd.DataFrame(self.live_rows))
+        return True
+
+    def show_timing(self, measurement):
+        """Show where the time of the last run went, if the sdr's timing
+        is on (see Measurement.report_timing)."""
+        timing = getattr(measurement, 'timing', None)
+        if timing is None:
+            return
+        text = timing.to_string(float_format=lambda x: '%.3g' % x)
+        showinfo('Timing per point (s, share of total)', text)
+
+    def go_save(self, measurement):
+        """
+        Save the data of a measurement as a tab separated csv, plus the
+        binary column store (filename + '.cols', see sdr_storage). The
+        store is copied from the autosave if there is one, rather than
+        serializing the table again, with the run's timing report if there
+        is one. A raw IQ recording of the run is copied to filename + 
+        '.iq'.
+        """
         filename = asksaveasfilename()
+        df = measurement.data
         df.to_csv(filename, sep='\t', float_format='%.6e', index_label='i')
-        with open(filename+'.p', 'wb') as f:
-            pickle.dump(obj=df, file=f)
-#        pickle.dump(obj=df, file=filename)
+        if measurement.autosave is not None:
+            shutil.copytree(measurement.autosave, filename + '.cols', 
+                            dirs_exist_ok=True)
+        else:
+            save_results(filename + '.cols', df)
+            if getattr(measurement, 'timing', None) is not None:
+                save_timing_report(measurement.timing, filename + '.cols')
+        if (measurement.autosave is not None and 
+                os.path.exists(measurement.autosave + '_iq')):
+            shutil.copytree(measurement.autosave + '_iq', filename + '.iq',
+                            dirs_exist_ok=True)
 
     def go_biassweep(self):
         step = self.tbs.step_v.get()
         nsteps = self.tbs.nsteps.get()
         points = self.biassweep.triwave(step, nsteps, add_final_zero=True)
-        self.biassweep.run(points)
-        self.update_bs_plot(self.tbs.graph)
+        graph = self.tbs.graph
+        self.run_measurement(self.biassweep, 'biassweep', 
+                             lambda df: self.update_bs_plot(graph, df=df),
+                             points)
         
     def go_biassweepcv(self):
         step = self.tbscv.step_v.get()
         nsteps = self.tbscv.nsteps.get()
         points = self.biassweepcv.triwave(step, nsteps, add_final_zero=True)
-        self.biassweepcv.run(points)
-        self.update_bscv_plot()
+        self.run_measurement(self.biassweepcv, 'biassweepcv', 
+                             lambda df: self.update_bscv_plot(df),
+                             points)
+
+    def go_areascan(self):
+        # The maps fill in as the points come in
+        self.run_measurement(
+                self.areascan, 'areascan', lambda df: self.update_as_plot(),
+                step_um=(self.tas.step_x_um.get(), self.tas.step_y_um.get()),
+                nsteps=(self.tas.nsteps_x.get(), self.tas.nsteps_y.get()),
+                pipelined=bool(self.tas.pipelined.get()))
+
+    def go_freqsweep(self):
+        # Whole Hz, as multi-tone needs
+        freqs = np.round(np.linspace(self.tfs.start_khz.get(), 
+                                     self.tfs.stop_khz.get(), 
+                                     self.tfs.npoints.get()) * 1e3)
+        graph = self.tfs.graph
+        self.run_measurement(self.freqsweep, 'freqsweep', 
+                             lambda df: self.update_fs_plot(graph, df=df),
+                             freqs, vpp=self.tfg.vpp.get(), 
+                             offset_v=self.tfg.offset.get(),
+                             multitone=bool(self.tfs.multitone.get()))
+
+    def update_as_plot(self):
+        icol = self.tas.rb.get()
+        col = self.tas.rb_labels[icol]
+        unit_labs = ['pm/V', 'um/s', 'pm']
+        unit_coef = [1e12, 1e6, 1e12]
+        ax = self.tas.graph.ax[0]
+        if col not in self.areascan.maps:
+            return
+        x, y = self.areascan.x_um, self.areascan.y_um
+        values = self.areascan.maps[col] * unit_coef[icol]
+        extent = (x[0], x[-1], y[0], y[-1])
+        # Update the image in place rather than clearing the axes
+        if ax.images:
+            image = ax.images[0]
+            image.set_data(values)
+            image.set_extent(extent)
+        else:
+            image = ax.imshow(values, origin='lower', extent=extent, 
+                              aspect='auto')
+        measured = values[np.isfinite(values)]
+        if len(measured):
+            image.set_clim(measured.min(), measured.max())
+        ax.set_title(col + ' ' + unit_labs[icol])
+        ax.set_xlabel('x (um)')
+        ax.set_ylabel('y (um)')
+        ax.figure.canvas.draw_idle()
 
-    def update_ls_plot(self, graph, i_ax=0):
-        df = self.linescan.data
+    def update_ls_plot(self, graph, i_ax=0, df=None):
+        if df is None:
+            df = self.linescan.data
         icol = self.tls.rb.get()
         col = self.tls.rb_labels[icol]
         xlabel = 'Position (um)'
         xcol = 'loc_um'
         self.update_plot(graph, i_ax, df, xcol, col, icol, xlabel)
         
-    def update_bs_plot(self, graph, i_ax=0):
-        df = self.biassweep.data
+    def update_bs_plot(self, graph, i_ax=0, df=None):
+        if df is None:
+            df = self.biassweep.data
         icol = self.tbs.rb.get()
         col = self.tbs.rb_labels[icol]
         xcol = 'bias_v'
         xlabel = 'Bias (V)'
         self.update_plot(graph, i_ax, df, xcol, col, icol, xlabel)
         
-    def update_bscv_plot(self):
-        df = self.biassweepcv.data
+    def update_fs_plot(self, graph, i_ax=0, df=None):
+        if df is None:
+            df = self.freqsweep.data
+        icol = self.tfs.rb.get()
+        col = self.tfs.rb_labels[icol]
+        xcol = 'freq_hz'
+        xlabel = 'Freq (Hz)'
+        self.update_plot(graph, i_ax, df, xcol, col, icol, xlabel)
+
+    def update_bscv_plot(self, df=None):
+        if df is None:
+            df = self.biassweepcv.data
         icol = self.tbscv.rb.get()
         col = self.tbscv.rb_labels[icol]
         xcol = 'bias_v'
         xlabel = 'Bias (V)'
         ax = self.tbscv.graph.ax[0]
         ax2 = self.tbscv.graph.ax[1]
-        ax.cla()
-        ax2.cla()
         unit_labs = ['pm/V', 'um/s', 'pm']
         unit_coef = [1e12, 1e6, 1e12]
-        ax.plot(df[xcol] , df[col] * unit_coef[icol])
+        self.set_line(ax, df[xcol], df[col] * unit_coef[icol])
         ax.set_ylabel(col + ' ' + unit_labs[icol])
         ax2.set_xlabel(xlabel)
-        ax2.plot(df[xcol], df['r'], 'C1')
+        self.set_line(ax2, df[xcol], df['r'], 'C1')
         ax2.set_ylabel('Lockin R')
-        ax.figure.canvas.draw()
         ax.figure.tight_layout()
+        ax.figure.canvas.draw_idle()
 
     def update_plot(self, graph, i_ax, df, xcol, col, icol, xlabel):
         ax = graph.ax[i_ax]
-        ax.cla()
         unit_labs = ['pm/V', 'um/s', 'pm']
         unit_coef = [1e12, 1e6, 1e12]
-        ax.plot(df[xcol] , df[col] * unit_coef[icol])
+        self.set_line(ax, df[xcol] , df[col] * unit_coef[icol])
         ax.set_ylabel(col + ' ' + unit_labs[icol])
         ax.set_xlabel(xlabel)
-        ax.figure.canvas.draw()
+        ax.figure.canvas.draw_idle()
+
+    def set_line(self, ax, x, y, fmt='C0'):
+        """Plot x, y as the line on ax, updating its data (and the axis 
+        limits) if it is already there rather than clearing and 
+        replotting."""
+        if ax.lines:
+            ax.lines[0].set_data(x, y)
+            ax.relim()
+            ax.autoscale_view()
+        else:
+            ax.plot(x, y, fmt)
     
     def sync_fg_sdr_tabs(self):
         self.tsdr.ppk_voltage.set(self.tfg.vpp.get())
         self.tsdr.modulation_freq.set(self.tfg.freq.get())
-        self.update_sdr_params()
+        # Otherwise sent with the next spectrum
+        if not self.busy():
+            self.update_sdr_params()
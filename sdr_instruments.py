@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 21:48:50 2026
+
+@author: rzchlab
+
+On demand instrument connections. Each instrument is registered with a
+factory (which imports its driver), all of them connect in parallel in the
+background, and the rest of the program holds LazyInstrument stand-ins
+that wait for the connection on first use:
+
+    instruments = InstrumentRegistry()
+    instruments.register('fg', open_func_gen)
+    instruments.connect_all()
+    fg = instruments.proxy('fg')
+
+A missing or busy instrument only fails where it is used (its error is
+raised there), the rest of the program carries on.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+
+class InstrumentRegistry(object):
+    def __init__(self, max_workers=8):
+        """
+        Args:
+            max_workers (int): connections opened at the same time. A
+                factory may get() an instrument registered before it (e.g.
+                a VISA resource manager), so keep this at least the number
+                of instruments.
+        """
+        self.factories = {}
+        self.futures = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers,
+                                            thread_name_prefix='connect')
+
+    def register(self, name, factory):
+        """Register factory(), which opens and returns instrument name."""
+        self.factories[name] = factory
+        pass
+
+    def connect(self, name):
+        """Start connecting instrument name in the background, unless it
+        already is. Returns the connection's Future."""
+        with self._lock:
+            if name not in self.futures:
+                self.futures[name] = self._executor.submit(
+                        self.factories[name])
+            return self.futures[name]
+
+    def connect_all(self):
+        """Start connecting every instrument, in registration order."""
+        for name in self.factories:
+            self.connect(name)
+
+    def reconnect(self, name):
+        """Try a failed instrument again. Returns the new Future."""
+        with self._lock:
+            future = self.futures.get(name)
+            if future is not None and future.done() and future.exception():
+                del self.futures[name]
+        return self.connect(name)
+
+    def get(self, name, timeout=None):
+        """Instrument name, connecting it (or waiting for the background
+        connection) if needed. Raises its connection error."""
+        return self.connect(name).result(timeout)
+
+    def proxy(self, name):
+        """LazyInstrument standing in for instrument name."""
+        return LazyInstrument(self, name)
+
+    def status(self):
+        """{name: 'not connected', 'connecting', 'connected' or the
+        connection error}."""
+        status = {}
+        for name in self.factories:
+            future = self.futures.get(name)
+            if future is None:
+                status[name] = 'not connected'
+            elif not future.done():
+                status[name] = 'connecting'
+            elif future.exception() is not None:
+                status[name] = repr(future.exception())
+            else:
+                status[name] = 'connected'
+        return status
+
+    def close_all(self):
+        """Close the connected instruments that have a close method."""
+        for future in self.futures.values():
+            if future.done() and future.exception() is None:
+                close = getattr(future.result(), 'close', None)
+                if close is not None:
+                    close()
+        self._executor.shutdown(wait=False)
+
+
+class LazyInstrument(object):
+    """
+    Stand-in for an instrument of an InstrumentRegistry. Attribute access
+    is forwarded to the instrument, which is connected (or waited for) on
+    first use.
+    """
+    def __init__(self, registry, name):
+        object.__setattr__(self, '_registry', registry)
+        object.__setattr__(self, '_name', name)
+
+    def __getattr__(self, attr):
+        return getattr(self._registry.get(self._name), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._registry.get(self._name), attr, value)
+
+    def __repr__(self):
+        return '<LazyInstrument %s>' % self._name
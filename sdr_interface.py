@@ -12,21 +12,466 @@ Notes on style:
 
 """
 
-from rtlsdr import RtlSdr
-from scipy.fftpack import fft
-from scipy import signal
+import collections
+import functools
+import queue
+import threading
+import time
+import scipy.fft
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from sdr_storage import IqRecorder, open_iq, read_iq_index
+from sdr_timing import NullTimer, StageTimer
+
+
+# a_k of the 4 term Blackman-Harris window, sum (-1)^k a_k cos(2 pi k n/N)
+BLACKMANHARRIS_COEFFS = (0.35875, 0.48829, 0.14128, 0.01168)
+# Half width (in bins) of its main lobe
+MAIN_LOBE_BINS = 4
+# HeNe laser wavelength (m)
+LAMBDA_HENE = 632.8e-9
+
+# Settings of SdrInterface.configure and their setters, in the order they
+# are applied (decimation has to divide n_samples, and 'auto' depends on 
+# the settings before it)
+CONFIG_SETTERS = (('center_freq', 'set_center_freq'),
+                  ('sample_freq', 'set_sample_freq'),
+                  ('gain_level', 'set_gain_level'),
+                  ('n_samples', 'set_n_samples'),
+                  ('modulation_freq', 'set_modulation_freq'),
+                  ('ppk_voltage', 'set_voltage'),
+                  ('max_order', 'set_max_order'),
+                  ('decimation', 'set_decimation'),
+                  ('target_snr', 'set_adaptive'))
+# Settings after whose change the tuner has to settle
+SETTLE_SETTINGS = ('center_freq', 'sample_freq', 'gain_level')
+
+# What SdrInterface.configure changed: the names of the settings written,
+# and whether the tuner had to settle
+ConfigChange = collections.namedtuple('ConfigChange', ('changed', 'settle'))
+
+
+@functools.lru_cache(maxsize=8)
+def blackmanharris_window(n_samples):
+    """Cached (read only) periodic Blackman-Harris window."""
+    # As scipy.signal.windows.blackmanharris(n_samples, sym=False), which
+    # takes most of a second to import
+    phase = 2 * np.pi * np.arange(n_samples) / n_samples
+    window = sum((-1)**k * a * np.cos(k * phase) 
+                 for k, a in enumerate(BLACKMANHARRIS_COEFFS))
+    window.flags.writeable = False
+    return window
+
+
+@functools.lru_cache(maxsize=4)
+def get_transform_engine(n_samples, sample_freq, dtype=np.complex128):
+    """Cached TransformEngine for (n_samples, sample_freq, dtype)."""
+    return TransformEngine(n_samples, sample_freq, dtype)
+
+
+class TransformEngine(object):
+    """
+    FFT setup for one (n_samples, sample_freq, dtype): the window, the 
+    frequency axis, pruned_fft twiddles and per-thread work buffers. Get one
+    from get_transform_engine instead of building it for every spectrum.
+    """
+    def __init__(self, n_samples, sample_freq, dtype=np.complex128):
+        """
+        Args:
+            n_samples (int): samples per transform
+            sample_freq (float): sampling freq, for the frequency axis
+            dtype: complex64 or complex128 work precision
+        """
+        self.n_samples = n_samples
+        self.sample_freq = sample_freq
+        self.dtype = np.dtype(dtype)
+        window = np.array(blackmanharris_window(n_samples))
+        # Modulating the window by (-1)^n shifts the spectrum by n_samples/2
+        # bins, so the FFT comes out centered without an np.roll copy
+        self.shifted = n_samples % 2 == 0
+        if self.shifted:
+            window[1::2] *= -1
+        self.window = window.astype(self.dtype.char.lower())
+        self.freqs = np.linspace(-sample_freq/2, sample_freq/2, n_samples)
+        self.freqs.flags.writeable = False
+        self._twiddles = {}
+        self._local = threading.local()
+
+    def windowed(self, time_series):
+        """Multiply by the window into this thread's work buffer."""
+        work = getattr(self._local, 'work', None)
+        if work is None:
+            work = self._local.work = np.empty(self.n_samples, self.dtype)
+        np.multiply(time_series, self.window, out=work, casting='same_kind')
+        return work
+
+    def centered_fft(self, time_series, workers=None):
+        """Windowed FFT of time_series, with DC at n_samples//2."""
+        # No overwrite_x, scipy would hand back the work buffer itself
+        spectrum = scipy.fft.fft(self.windowed(time_series), workers=workers)
+        if not self.shifted:
+            spectrum = np.roll(spectrum, self.n_samples//2)
+        return spectrum
+
+    def centered_bins(self, time_series, starts, length, workers=None):
+        """
+        Bins [start, start + length) of the centered_fft of time_series for
+        each start, computed with pruned_fft.
+        """
+        if not self.shifted:
+            starts = [start - self.n_samples//2 for start in starts]
+        block_len = pruned_block_len(self.n_samples, len(starts) * length)
+        key = (length, block_len)
+        if key not in self._twiddles:
+            n_blocks = self.n_samples // block_len
+            self._twiddles[key] = np.exp(
+                    -2j * np.pi * np.outer(np.arange(length), 
+                                           np.arange(n_blocks))
+                    / self.n_samples).astype(self.dtype)
+        return pruned_fft(self.windowed(time_series), starts, length, 
+                          block_len, self._twiddles[key], workers)
+
+
+def pruned_block_len(n_samples, n_bins):
+    """
+    Choose the block length for pruned_fft: the power of two dividing
+    n_samples that minimizes the cost of the block FFTs plus the cost of
+    combining them for n_bins output bins.
+    """
+    best_len, best_cost = 1, np.inf
+    block_len = 1
+    while n_samples % block_len == 0 and block_len <= n_samples:
+        cost = np.log2(block_len) + 2 * n_bins / block_len
+        if cost < best_cost:
+            best_len, best_cost = block_len, cost
+        block_len *= 2
+    return best_len
+
+
+def pruned_fft(x, starts, length, block_len=None, twiddle=None, 
+               workers=None):
+    """
+    Evaluate `length` consecutive DFT bins of x starting at each bin index
+    in `starts`, without computing the full FFT.
+
+    x is split into block_len blocks of n_blocks = len(x)/block_len samples.
+    One FFT of length block_len per interleaved sub-series is shared by all
+    windows, so each window only costs length * n_blocks multiplies.
+    Bin indices are in fft order (0 is DC) and may be negative. twiddle
+    can be passed in to reuse it between calls with the same length and
+    block_len.
+
+    Returns array of shape (len(starts), length).
+    """
+    n_samples = len(x)
+    if block_len is None:
+        block_len = pruned_block_len(n_samples, len(starts) * length)
+    n_blocks = n_samples // block_len
+    # x[n_blocks * q + s] -> blocks[q, s], fft over q
+    blocks = scipy.fft.fft(np.reshape(x, (block_len, n_blocks)), axis=0,
+                           workers=workers)
+    s = np.arange(n_blocks)
+    m = np.arange(length)
+    if twiddle is None:
+        twiddle = np.exp(-2j * np.pi * np.outer(m, s) / n_samples)
+    out = np.empty((len(starts), length), dtype=blocks.dtype)
+    for j, start in enumerate(starts):
+        start = start % n_samples
+        rows = blocks[(start + m) % block_len]
+        shift = np.exp(-2j * np.pi * start * s / n_samples)
+        out[j] = (rows * twiddle) @ shift
+    return out
+
+
+@functools.lru_cache(maxsize=8)
+def decimation_taps(factor, taps_per_phase=24):
+    """
+    Cached (read only) low pass FIR for decimating by factor, cut off at the
+    decimated Nyquist freq. len(taps) - 1 is a multiple of factor.
+    """
+    from scipy import signal
+    taps = signal.firwin(factor * taps_per_phase + 1, 1 / factor, 
+                         window=('kaiser', 8.0))
+    taps.flags.writeable = False
+    return taps
+
+
+class Decimator(object):
+    """
+    Low pass filter and decimate a stream of IQ blocks. The filter state is
+    kept between blocks, so the output doesn't depend on how the stream is
+    cut up. Flat (and alias free) up to passband * the decimated Nyquist
+    freq.
+    """
+    passband = 0.8
+
+    def __init__(self, factor, taps_per_phase=24):
+        """
+        Args:
+            factor (int): decimation factor
+            taps_per_phase (int): filter length / factor
+        """
+        self.factor = factor
+        self.taps = decimation_taps(factor, taps_per_phase)
+        # complex, so the dot products go straight to BLAS
+        self._reversed = self.taps[::-1].astype(complex)
+        self.reset()
+
+    def reset(self):
+        """Start a new stream (zero filter state)."""
+        self._history = np.zeros(len(self.taps) - 1, dtype=complex)
+
+    def process(self, block):
+        """Filter the next block of the stream. Returns the decimated 
+        samples it completes (len(block) / factor on average)."""
+        x = np.concatenate((self._history, block))
+        n_out = (len(x) - len(self.taps)) // self.factor + 1
+        if n_out <= 0:
+            self._history = x
+            return np.empty(0, dtype=complex)
+        # Only every factor-th output is evaluated: output k is the taps
+        # dotted with the inputs ending at len(taps) - 1 + k * factor, a
+        # strided view of x
+        windows = sliding_window_view(x, len(self.taps))[::self.factor]
+        self._history = x[n_out * self.factor:]
+        return windows[:n_out] @ self._reversed
+
+
+def window_kernel(offset):
+    """
+    Magnitude of the transform of the Blackman-Harris window offset bins
+    from its center, normalized to 1 at 0 (in the large n_samples limit).
+    This is the shape every peak in the spectrum has.
+    """
+    offset = np.asarray(offset, dtype=float)
+    a = BLACKMANHARRIS_COEFFS
+    kernel = a[0] * np.sinc(offset)
+    for k in range(1, len(a)):
+        kernel += a[k] / 2 * (np.sinc(offset - k) + np.sinc(offset + k))
+    return np.abs(kernel) / a[0]
+
+
+@functools.lru_cache(maxsize=1)
+def _offset_table():
+    """log(right / left neighbour) of a peak vs its offset from the bin."""
+    offsets = np.linspace(-0.5, 0.5, 2001)
+    log_ratios = np.log(window_kernel(1 - offsets) 
+                        / window_kernel(1 + offsets))
+    return log_ratios, offsets
+
+
+def interpolate_peaks(left, center, right):
+    """
+    Sub-bin estimate of peaks from their max bin (center) and its two
+    neighbours, arrays of any (matching) shape. The offset of the true
+    frequency from the center bin (in bins, +-0.5) is found by inverting
+    the neighbour ratio against window_kernel, and the height is the least
+    squares fit of the kernel at that offset to all three bins, so it
+    doesn't depend on where the peak falls between bins (no scalloping).
+
+    Returns offsets, heights.
+    """
+    log_ratios, offsets = _offset_table()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.interp(np.log(right / left), log_ratios, offsets)
+    kernels = [window_kernel(-1 - offset), window_kernel(offset), 
+               window_kernel(1 - offset)]
+    heights = ((left * kernels[0] + center * kernels[1] 
+                + right * kernels[2]) / sum(k**2 for k in kernels))
+    return offset, heights
+
+
+def envelope(x, y, lo, hi, n_pixels):
+    """
+    Reduce a line plot of y vs x (increasing) over [lo, hi] to what 
+    n_pixels columns can show: the min and max of y in each column, in 
+    order. Returns x, y of at most 2 * n_pixels + 2 points.
+    """
+    start, stop = np.searchsorted(x, [lo, hi])
+    # keep a point past each edge, so the line runs to the axis edges
+    x = x[max(start - 1, 0):stop + 1]
+    y = y[max(start - 1, 0):stop + 1]
+    per_pixel = len(x) // n_pixels
+    if per_pixel < 2:
+        return x, y
+    starts = np.arange(0, len(x), per_pixel)
+    lows = np.minimum.reduceat(y, starts)
+    highs = np.maximum.reduceat(y, starts)
+    return np.repeat(x[starts], 2), np.column_stack((lows, highs)).ravel()
+
+
+def demodulation_blocks(n_samples, cycles_per_sample, max_order, 
+                        block=2**14):
+    """
+    The least squares basis of demodulate_phase, block by block so the 
+    whole (2 + 2 max_order) x n_samples basis is never in memory. Yields
+    the first sample of each block and its rows: offset, linear drift, 
+    then cos, sin of each harmonic. The rows are overwritten by the next
+    block.
+    """
+    rows = np.empty((2 + 2 * max_order, block))
+    rows[0] = 1
+    # exp(2 pi i f n) as the block's start times per block steps, cheaper
+    # than exp of every sample
+    steps = np.exp(2j * np.pi * cycles_per_sample * np.arange(block))
+    for start in range(0, n_samples, block):
+        n = min(block, n_samples - start)
+        block_rows = rows[:, :n]
+        # linspace(-1, 1, n_samples), scaled so the normal equations stay
+        # well conditioned
+        block_rows[1] = np.arange(start, start + n) * (
+                2 / max(n_samples - 1, 1)) - 1
+        rotation = np.exp(2j * np.pi * cycles_per_sample * start) * steps[:n]
+        harmonic = rotation.copy()
+        for k in range(max_order):
+            block_rows[2 + 2*k] = harmonic.real
+            block_rows[3 + 2*k] = harmonic.imag
+            harmonic *= rotation
+        yield start, block_rows
+
+
+@functools.lru_cache(maxsize=32)
+def demodulation_gram_inverse(n_samples, cycles_per_sample, max_order):
+    """Cached (read only) inverse of the Gram matrix of the 
+    demodulate_phase basis, only (2 + 2 max_order) square."""
+    gram = sum(rows @ rows.T for _, rows in demodulation_blocks(
+            n_samples, cycles_per_sample, max_order))
+    inverse_gram = np.linalg.inv(gram)
+    inverse_gram.flags.writeable = False
+    return inverse_gram
+
+
+def unwrapped_phase(time_series):
+    """np.unwrap(np.angle(time_series)), from the phase steps between 
+    samples (several times faster)."""
+    phase = np.empty(len(time_series))
+    phase[0] = np.angle(time_series[0])
+    steps = np.angle(time_series[1:] * np.conj(time_series[:-1]))
+    np.cumsum(steps, out=phase[1:])
+    phase[1:] += phase[0]
+    return phase
+
+
+def demodulate_phase(time_series, sample_freq, modulation_freq, max_order):
+    """
+    Digital lock-in on the optical phase of an LDV capture. The unwrapped
+    phase of the IQ samples is least squares fitted, in one pass over the
+    samples, with an offset, a linear carrier drift and cos/sin at 
+    modulation_freq and its harmonics up to max_order. Unlike the peak 
+    ratios this holds at any modulation depth, as long as the phase 
+    unwraps (noise or a DC offset comparable to the carrier cause cycle
+    slips).
+
+    Returns the modulation index (rad) and phase (rad, of the sine at the 
+    first sample) of each harmonic, and the carrier offset (Hz).
+    """
+    n_samples = len(time_series)
+    cycles_per_sample = modulation_freq / sample_freq
+    phase = unwrapped_phase(time_series)
+    projections = sum(rows @ phase[start:start + rows.shape[1]]
+                      for start, rows in demodulation_blocks(
+                              n_samples, cycles_per_sample, max_order))
+    coeffs = demodulation_gram_inverse(
+            n_samples, cycles_per_sample, max_order) @ projections
+    cos_coeffs, sin_coeffs = coeffs[2::2], coeffs[3::2]
+    duration = (n_samples - 1) / sample_freq
+    carrier_freq = 2 * coeffs[1] / duration / (2 * np.pi)
+    return (np.hypot(cos_coeffs, sin_coeffs), 
+            np.arctan2(cos_coeffs, sin_coeffs), carrier_freq)
+
+
+class PhaseDemodulation(object):
+    """
+    Displacement, speed, d33 and phase of each harmonic from 
+    demodulate_phase, the time domain counterpart of SpectrumAnalysis. 
+    Built by SdrInterface.demodulate.
+    """
+    def __init__(self, sdr, time_series):
+        """
+        Args:
+            sdr (SdrInterface): holds the settings and unit conversions
+            time_series (array): capture at sdr.analysis_freq()
+        """
+        (self.modulation_index, self.phase, 
+         self.carrier_freq) = demodulate_phase(time_series, 
+                                               sdr.analysis_freq(),
+                                               sdr.modulation_freq, 
+                                               sdr.max_order)
+        # Reflected beam: 4 pi d / lambda of phase
+        self.displacement = self.modulation_index * LAMBDA_HENE / (4*np.pi)
+        mod_freqs = (1 + np.arange(sdr.max_order)) * sdr.modulation_freq
+        self.speed = 2 * np.pi * mod_freqs * self.displacement
+        # One sided Carson bandwidth (Hz): peak frequency deviation plus 
+        # the highest harmonic
+        self.bandwidth = mod_freqs @ self.modulation_index + mod_freqs[-1]
+        self.total_d33, self.d33 = sdr.d33_from_displacement(
+                self.displacement)
+
+
+class SpectrumAnalysis(object):
+    """
+    Everything derived from the peaks of one spectrum: peak indices, peak
+    ratios, speed, displacement, d33, phases and signal to noise. Built 
+    once per spectrum (and set of analysis parameters) by 
+    SdrInterface.get_analysis.
+    """
+    def __init__(self, sdr, key, peaks, magnitude=None, phase=None):
+        """
+        Args:
+            sdr (SdrInterface): holds the unit conversions, and the spectrum
+                unless magnitude and phase are given
+            key (tuple): analysis parameters the result is valid for
+            peaks (array): peak indices from find_peaks
+            magnitude (array): magnitude spectrum, default sdr.magnitude
+            phase (array): phase spectrum, default sdr.phase
+        """
+        if magnitude is None:
+            magnitude, phase = sdr.magnitude, sdr.phase
+        self.key = key
+        self.peaks = peaks
+        self.posneg_ratios = sdr.ratios_from_peaks(magnitude, peaks,
+                                                   avg_posneg=False)
+        self.ratios = np.mean(self.posneg_ratios, axis=1)
+        self.speed = sdr.speed_from_ratios(self.ratios)
+        self.displacement = sdr.displacement_from_speed(self.speed)
+        self.total_d33, self.d33 = sdr.d33_from_displacement(
+                self.displacement)
+        theta = phase[peaks]
+        self.phase = 0.5 * (np.abs(theta[:, 0] - theta[:, 1]) % np.pi)
+        theta_sum = np.abs(theta[:, 0] + theta[:, 1]) % np.pi
+        self.phase_check = 0.5 * (theta_sum - theta_sum[0])
+        self.noise_floor = sdr.noise_floor(magnitude, peaks)
+        self.snr = sdr.peak_heights(magnitude, peaks) / self.noise_floor
+
 
 class SdrInterface(object):
     """Abstract class for interfacing with an SDR."""
+    # Half width (in bins) of the window searched around each harmonic
+    peak_width = 100
+
     def __init__(self, center_freq, sample_freq, n_samples, modulation_freq, 
-                 ppk_voltage, max_order):
+                 ppk_voltage, max_order, analysis_mode='full'):
         self.set_center_freq(center_freq)
         self.set_sample_freq(sample_freq)
         self.set_n_samples(n_samples)
         self.set_modulation_freq(modulation_freq)
         self.set_voltage(ppk_voltage)
         self.set_max_order(max_order)
+        self.set_analysis_mode(analysis_mode)
+        self.set_averaging(1)
+        self.set_fft_options()
+        self.set_decimation(1)
+        self.set_peak_estimation()
+        self.set_adaptive(None)
+        self.set_timing(False)
+        self.recorder = None
+        self.capture_tags = {}
+        self._plot_lines = {}
+        self._db_cache = {}
+        self.bin_indices = None
+        self._peaks = None
+        self._analysis = None
+        self.ratio_samples = None
 
         
     def set_center_freq(self, center_freq):
@@ -42,7 +487,7 @@ class SdrInterface(object):
     def set_n_samples(self, n_samples):
         """Set number of samples to acquire."""
         self.n_samples = n_samples
-        self.fft_window = signal.blackmanharris(n_samples, sym=False)
+        self.fft_window = blackmanharris_window(n_samples)
         pass
     
     def set_modulation_freq(self, modulation_freq):
@@ -60,6 +505,20 @@ class SdrInterface(object):
         self.max_order = max_order
         pass
 
+    def set_analysis_mode(self, analysis_mode):
+        """
+        Set how get_spectrum transforms the samples.
+
+        'full' computes every FFT bin. 'harmonic' only computes the bins
+        within peak_width of each harmonic of modulation_freq, which is all
+        find_peaks, peak_ratios and get_d33 read. plot_spectrum computes the
+        full spectrum on demand.
+        """
+        if analysis_mode not in ('full', 'harmonic'):
+            raise ValueError("analysis_mode must be 'full' or 'harmonic'")
+        self.analysis_mode = analysis_mode
+        pass
+
     
     def get_samples(self):
         """
@@ -67,24 +526,498 @@ class SdrInterface(object):
         self.time_series
         """
         pass
+
+    def acquire(self):
+        """get_samples, decimate (see set_decimation) and record the 
+        capture if recording."""
+        with self.timer.stage('samples'):
+            time_series = self.get_samples()
+        if self.decimation > 1:
+            with self.timer.stage('decimate'):
+                time_series = self.time_series = self.decimate(time_series)
+        self._record(time_series)
+        return time_series
+
+    def set_decimation(self, factor):
+        """
+        Low pass filter and decimate each capture by factor before the 
+        spectral analysis (see Decimator). The frequency resolution stays
+        the same, while the FFT is factor times smaller. Everything beyond
+        Decimator.passband * sample_freq / (2 * factor) is lost, see 
+        auto_decimation. 1 to turn off.
+        """
+        if self.n_samples % factor:
+            raise ValueError('factor must divide n_samples')
+        if (self.average_mode == 'segments' 
+                and (self.n_samples // factor) % self.n_averages):
+            raise ValueError('n_averages must divide the decimated '
+                             'n_samples')
+        self.decimation = factor
+        pass
+
+    def auto_decimation(self):
+        """
+        Largest power of 2 decimation that keeps the harmonics up to 
+        max_order (and the plot_spectrum range) in the passband.
+        """
+        band = (self.max_order + 1.1) * self.modulation_freq
+        factor = 1
+        while (self.n_samples % (2 * factor) == 0 and band <= 
+               Decimator.passband * self.sample_freq / (4 * factor)):
+            factor *= 2
+        return factor
+
+    def analysis_freq(self):
+        """Sample freq of the captures after decimation."""
+        return self.sample_freq / self.decimation
+
+    def passband(self):
+        """Highest offset from center_freq (Hz) the analysis still sees,
+        after decimation."""
+        if self.decimation == 1:
+            return self.sample_freq / 2
+        return Decimator.passband * self.analysis_freq() / 2
+
+    def decimate(self, time_series):
+        """Decimate one capture (starting from zero filter state, the 
+        transient is at the very start where the window is ~0)."""
+        return Decimator(self.decimation).process(time_series)
+
+    def start_recording(self, path, overwrite=True):
+        """
+        Record the raw IQ of every capture from now on to path (see
+        sdr_storage.IqRecorder), for ReplaySdrInterface to reprocess.
+        """
+        self.stop_recording()
+        self.recorder = IqRecorder(path, overwrite)
+
+    def stop_recording(self):
+        """Stop recording raw IQ."""
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def tag_captures(self, **tags):
+        """
+        Set extra metadata (e.g. bias_v or loc_um) recorded with the 
+        following captures. Call with no arguments to clear.
+        """
+        self.capture_tags = tags
+
+    def capture_metadata(self):
+        """Settings recorded with each capture."""
+        return dict(center_freq=self.center_freq, 
+                    sample_freq=self.analysis_freq(),
+                    modulation_freq=self.modulation_freq, 
+                    ppk_voltage=self.ppk_voltage,
+                    gain_level=getattr(self, 'gain_level', None),
+                    time=time.time(), **self.capture_tags)
+
+    def _record(self, time_series):
+        """Record a capture, if recording."""
+        if self.recorder is not None:
+            self.recorder.record(time_series, self.capture_metadata())
     
+    def set_averaging(self, n_averages, average_mode='captures'):
+        """
+        Average the magnitude of n_averages spectra per get_spectrum.
+
+        'captures' takes n_averages captures of n_samples each. 'segments'
+        splits one capture into n_averages segments, so each FFT (and the
+        frequency resolution) is n_averages times shorter. The spread of the
+        per-spectrum peak ratios gives the errors from get_statistics.
+        """
+        if average_mode not in ('captures', 'segments'):
+            raise ValueError("average_mode must be 'captures' or 'segments'")
+        if (average_mode == 'segments' 
+                and (self.n_samples // self.decimation) % n_averages):
+            raise ValueError('n_averages must divide the decimated '
+                             'n_samples')
+        self.n_averages = n_averages
+        self.average_mode = average_mode
+        pass
+
+    def set_peak_estimation(self, peak_estimation='interpolated'):
+        """
+        How peak heights are measured for the peak ratios: 'interpolated'
+        fits the window's peak shape around the max bin (see 
+        interpolate_peaks), 'bin' takes the max bin as is, which reads up
+        to ~0.8 dB low depending on where the peak falls between bins.
+        """
+        if peak_estimation not in ('interpolated', 'bin'):
+            raise ValueError("peak_estimation must be 'interpolated' or "
+                             "'bin'")
+        self.peak_estimation = peak_estimation
+        pass
+
+    def analysis_key(self):
+        """Analysis parameters a SpectrumAnalysis depends on. The peak 
+        indices only depend on the first three."""
+        return (self.peak_width, self.max_order, self.modulation_freq, 
+                self.ppk_voltage, self.peak_estimation)
+
+    def set_fft_options(self, workers=-1, dtype=np.complex128):
+        """
+        Set the number of scipy.fft workers (-1 for all cores) and the work
+        precision (complex64 halves the memory traffic).
+        """
+        self.fft_workers = workers
+        self.fft_dtype = np.dtype(dtype)
+        pass
+
+    def configure(self, **settings):
+        """
+        Apply the given settings (see CONFIG_SETTERS), calling the setters
+        of only the ones that differ from the current values, in one batch.
+        Repeated calls with the same settings write nothing. decimation 
+        may be 'auto' (see auto_decimation, with the other new settings).
+
+        If a change needs the tuner to settle (SETTLE_SETTINGS), samples
+        taken before it are discarded (see discard_samples).
+
+        Returns a ConfigChange.
+        """
+        unknown = set(settings) - {name for name, _ in CONFIG_SETTERS}
+        if unknown:
+            raise ValueError('Unknown settings: %s' % ', '.join(unknown))
+        changed = []
+        for name, setter in CONFIG_SETTERS:
+            if name not in settings:
+                continue
+            value = settings[name]
+            if name == 'decimation' and value == 'auto':
+                value = self.auto_decimation()
+            if getattr(self, name, None) == value:
+                continue
+            if name == 'target_snr':
+                self.set_adaptive(value, self.min_samples, self.snr_orders)
+            else:
+                getattr(self, setter)(value)
+            changed.append(name)
+        settle = any(name in SETTLE_SETTINGS for name in changed)
+        if settle:
+            self.discard_samples()
+        return ConfigChange(tuple(changed), settle)
+
+    def set_timing(self, enabled):
+        """
+        Time the stages of each point (see sdr_timing): sample I/O, 
+        decimation, FFT and peak search here, plus the measurement's own
+        stages. Off, self.timer is a NullTimer and costs nothing measurable.
+        """
+        self.timer = StageTimer() if enabled else NullTimer()
+        pass
+
+    def get_engine(self, n_samples=None):
+        """Cached TransformEngine for n_samples (default the decimated 
+        capture length)."""
+        if n_samples is None:
+            n_samples = self.n_samples // self.decimation
+        return get_transform_engine(n_samples, self.analysis_freq(), 
+                                    self.fft_dtype)
+
+    def set_adaptive(self, target_snr, min_samples=2**15, orders=None):
+        """
+        Adaptive acquisition length: get_spectrum starts with min_samples
+        per capture and doubles it until the harmonics in orders (default 
+        all up to max_order) are target_snr above the noise floor (see 
+        check_point) or n_samples is reached. Each doubling extends the 
+        capture with new samples rather than starting over (see 
+        extend_capture), so strong points finish in a fraction of the time
+        of a full capture and weak ones only add the analysis of the 
+        shorter captures. None to turn off.
+
+        Averaging (set_averaging) is then over segments of the one 
+        capture in either mode, n_averages segments of up to n_samples in
+        'captures' mode.
+        """
+        self.target_snr = target_snr
+        self.min_samples = min_samples
+        self.snr_orders = orders
+        pass
+
     def get_spectrum(self, subtract_bg=False):
-        self.get_samples()  
-        self.spectrum = np.roll(fft(self.time_series * self.fft_window),
-                                self.n_samples//2)
-        self.magnitude = np.abs(self.spectrum)
-        self.phase = np.angle(self.spectrum)
-        self.freqs = np.linspace(-self.sample_freq/2, self.sample_freq/2,  
-                                 self.n_samples)
+        """Acquire samples and compute their spectrum as set by
+        self.analysis_mode, set_averaging and set_adaptive. Returns freqs, 
+        magnitude, phase."""
+        if self.target_snr is not None:
+            return self._adaptive_spectrum(subtract_bg)
+        return self._fixed_spectrum(subtract_bg)
+
+    def _adaptive_spectrum(self, subtract_bg=False):
+        """get_spectrum with doubling capture lengths, see set_adaptive."""
+        per_capture = 1
+        if self.average_mode == 'captures':
+            per_capture = self.n_averages
+        max_samples = self.n_samples * per_capture
+        n_samples = min(self.min_samples * per_capture, max_samples)
+        full = self.analysis_mode == 'full'
+        decimator = None
+        if self.decimation > 1:
+            decimator = Decimator(self.decimation)
+        capture = np.empty(max_samples // self.decimation, dtype=complex)
+        n_new, n_taken = n_samples, 0
+        self.start_extended_capture(max_samples)
+        try:
+            while True:
+                with self.timer.stage('samples'):
+                    samples = self.extend_capture(n_new)
+                if decimator is not None:
+                    with self.timer.stage('decimate'):
+                        samples = decimator.process(samples)
+                capture[n_taken:n_taken + len(samples)] = samples
+                n_taken += len(samples)
+                self.time_series = capture[:n_taken]
+                if self.n_averages > 1:
+                    segments = np.reshape(self.time_series, 
+                                          (self.n_averages, -1))
+                    result = self._average(
+                            (self.analyse(segment, full) 
+                             for segment in segments), subtract_bg)
+                else:
+                    result = self.set_block(
+                            self.analyse(self.time_series, full), 
+                            subtract_bg)
+                if 2 * n_samples > max_samples:
+                    break
+                orders = self.snr_orders
+                if orders is None:
+                    orders = np.arange(1, self.max_order + 1)
+                if np.min(self.check_point()[orders]) >= self.target_snr:
+                    break
+                n_new = n_samples
+                n_samples *= 2
+        finally:
+            self.stop_extended_capture()
+        self._record(self.time_series)
+        return result
+
+    def start_extended_capture(self, max_samples):
+        """
+        Start a capture of up to max_samples that extend_capture reads a
+        piece at a time, for adaptive acquisition. Backends whose 
+        consecutive get_samples calls don't continue each other override
+        these three methods.
+        """
+        pass
+
+    def extend_capture(self, n_samples):
+        """The next n_samples raw samples of the capture, continuing the
+        ones read before."""
+        n_capture, self.n_samples = self.n_samples, n_samples
+        try:
+            return self.get_samples()
+        finally:
+            self.n_samples = n_capture
+
+    def stop_extended_capture(self):
+        """End the capture of start_extended_capture."""
+        pass
+
+    def _fixed_spectrum(self, subtract_bg=False):
+        """get_spectrum with captures of n_samples."""
+        full = self.analysis_mode == 'full'
+        if self.n_averages > 1 and self.average_mode == 'captures':
+            blocks = (self.acquire_block(full) 
+                      for _ in range(self.n_averages))
+            return self._average(blocks, subtract_bg)
+        if self.n_averages > 1:
+            self.acquire()
+            return self.compute_spectrum(subtract_bg, full)
+        return self.set_block(self.acquire_block(full), subtract_bg)
+
+    def acquire_block(self, full=True):
+        """Acquire samples and analyse them, see analyse."""
+        self.acquire()
+        return self.analyse(self.time_series, full)
+
+    def compute_spectrum(self, subtract_bg=False, full=True):
+        """
+        Compute the spectrum of self.time_series.
+
+        If full is False only the bins in self.harmonic_bin_indices() are
+        computed. freqs, magnitude and phase then hold just those bins (in
+        increasing frequency) and self.bin_indices maps them back to the
+        full spectrum.
+        """
+        if self.n_averages > 1 and self.average_mode == 'segments':
+            segments = np.reshape(self.time_series, (self.n_averages, -1))
+            blocks = (self.analyse(segment, full) for segment in segments)
+            return self._average(blocks, subtract_bg)
+        return self.set_block(self.analyse(self.time_series, full), 
+                              subtract_bg)
+
+    def analyse(self, time_series, full=True):
+        """
+        Transform time_series and find its peaks without touching any state,
+        so it can run on a worker thread.
+
+        Returns a dict of freqs, spectrum, bin_indices (None if full),
+        magnitude, phase and peaks, plus the key (peak_width, max_order,
+        modulation_freq) the peaks were found with.
+        """
+        with self.timer.stage('fft'):
+            freqs, spectrum, bin_indices = self.transform(time_series, full)
+            magnitude = np.abs(spectrum)
+        return dict(
+                freqs=freqs, spectrum=spectrum, bin_indices=bin_indices,
+                magnitude=magnitude, phase=np.angle(spectrum),
+                key=self.analysis_key()[:3],
+                peaks=self.peak_indices(freqs, magnitude, self.peak_width))
+
+    def set_block(self, block, subtract_bg=False):
+        """Store a block from analyse as the current spectrum."""
+        self.set_spectrum(block['freqs'], block['spectrum'], 
+                          block['bin_indices'], subtract_bg,
+                          block['magnitude'], block['phase'])
+        # The peaks are only valid without bg subtraction
+        if not subtract_bg:
+            self._peaks = (block['key'], block['peaks'])
+        return self.freqs, self.magnitude, self.phase
+
+    def _average(self, blocks, subtract_bg=False):
+        """
+        Average the magnitudes of blocks from analyse in place, keeping the
+        peak ratios of each one in self.ratio_samples. The phase is the
+        phase of the last block.
+        """
+        block, magnitude, ratio_samples = self._accumulate(blocks)
+        self.set_spectrum(block['freqs'], block['spectrum'], 
+                          block['bin_indices'], subtract_bg, magnitude, 
+                          block['phase'])
+        self.ratio_samples = ratio_samples
+        return self.freqs, self.magnitude, self.phase
+
+    def _accumulate(self, blocks):
+        """
+        Sum the magnitudes of blocks in place. Returns the last block, the 
+        mean magnitude and the peak ratios of each block.
+        """
+        ratio_samples = []
+        magnitude = None
+        for block in blocks:
+            if magnitude is None:
+                magnitude = block['magnitude'].copy()
+            else:
+                magnitude += block['magnitude']
+            ratio_samples.append(self.ratios_from_peaks(block['magnitude'],
+                                                        block['peaks']))
+        magnitude /= len(ratio_samples)
+        return block, magnitude, np.array(ratio_samples)
+
+    def get_captures(self):
+        """
+        Acquire the raw captures for one measurement point (n_averages of
+        them in 'captures' averaging mode) without analysing them, for
+        analyse_captures to process later.
+        """
+        n_captures = 1
+        if self.average_mode == 'captures':
+            n_captures = self.n_averages
+        return [self.acquire() for _ in range(n_captures)]
+
+    def analyse_captures(self, captures):
+        """
+        Analyse captures from get_captures the way get_spectrum would,
+        without touching the current spectrum, so it can run on a worker
+        thread.
+
+        Returns a SpectrumAnalysis, and the statistics as from
+        get_statistics.
+        """
+        full = self.analysis_mode == 'full'
+        if self.n_averages > 1 and self.average_mode == 'segments':
+            captures = [segment for capture in captures 
+                        for segment in np.reshape(capture, 
+                                                  (self.n_averages, -1))]
+        blocks = (self.analyse(capture, full) for capture in captures)
+        block, magnitude, ratio_samples = self._accumulate(blocks)
+        key = self.analysis_key()
+        peaks = block['peaks']
+        if len(ratio_samples) > 1:
+            peaks = self.peak_indices(block['freqs'], magnitude, 
+                                      self.peak_width)
+        analysis = SpectrumAnalysis(self, key, peaks, magnitude, 
+                                    block['phase'])
+        return analysis, self.statistics_from_ratios(ratio_samples)
+
+    def transform(self, time_series, full=True):
+        """
+        Window and transform time_series (of any length).
+
+        Returns freqs, spectrum, bin_indices (None if full).
+        """
+        n_samples = len(time_series)
+        engine = self.get_engine(n_samples)
+        if full:
+            spectrum = engine.centered_fft(time_series, self.fft_workers)
+            return engine.freqs, spectrum, None
+        bin_indices = self.harmonic_bin_indices(n_samples)
+        spectrum = self._harmonic_spectrum(engine, time_series, bin_indices)
+        # same axis as the linspace used for the full spectrum
+        sample_freq = self.analysis_freq()
+        freqs = (-sample_freq/2 + bin_indices * sample_freq / (n_samples - 1))
+        return freqs, spectrum, bin_indices
+
+    def set_spectrum(self, freqs, spectrum, bin_indices, subtract_bg=False,
+                     magnitude=None, phase=None):
+        """
+        Store a spectrum from transform as the current one, optionally
+        subtracting the background. Returns freqs, magnitude, phase.
+        """
+        self.subtract_bg = subtract_bg
+        self.freqs = freqs
+        self.spectrum = spectrum
+        self.bin_indices = bin_indices
+        self.magnitude = np.abs(spectrum) if magnitude is None else magnitude
+        self.phase = np.angle(spectrum) if phase is None else phase
+        self._peaks = None
+        self._analysis = None
+        self.ratio_samples = None
         
         # subtracting the background doesn't really do much
         if subtract_bg:
             bg_mag = self.bg_magnitude
             # don't subtract center peak
-            center_index = self.n_samples//2
-            bg_mag[center_index-100:center_index+100] = 0 
+            center_index = len(bg_mag)//2
+            if bin_indices is None:
+                bg_mag[center_index-100:center_index+100] = 0 
+            else:
+                bg_mag = bg_mag[bin_indices]
+                bg_mag[np.abs(bin_indices - center_index + 0.5) < 100] = 0
             self.magnitude = np.abs(self.magnitude - bg_mag)
         return self.freqs, self.magnitude, self.phase
+
+    def harmonic_bin_indices(self, n_samples=None):
+        """
+        Indices (into the full, centered spectrum of n_samples, default
+        the decimated capture length) of the bins within peak_width of each
+        harmonic up to max_order, sorted and unique.
+        """
+        if n_samples is None:
+            n_samples = self.n_samples // self.decimation
+        sample_freq = self.analysis_freq()
+        orders = np.arange(-self.max_order, self.max_order + 1)
+        bin_spacing = sample_freq / (n_samples - 1)
+        centers = np.rint((orders * self.modulation_freq + sample_freq/2)
+                          / bin_spacing).astype(int)
+        offsets = np.arange(-self.peak_width, self.peak_width)
+        indices = (centers[:, None] + offsets).ravel()
+        indices = indices[(indices >= 0) & (indices < n_samples)]
+        return np.unique(indices)
+
+    def _harmonic_spectrum(self, engine, time_series, bin_indices):
+        """Evaluate the centered spectrum of time_series at bin_indices
+        only."""
+        # Split the indices into contiguous runs, one pruned_fft window each
+        breaks = np.flatnonzero(np.diff(bin_indices) != 1) + 1
+        runs = np.split(bin_indices, breaks)
+        length = max(len(run) for run in runs)
+        starts = [run[0] for run in runs]
+        windows = engine.centered_bins(time_series, starts, length, 
+                                       self.fft_workers)
+        return np.concatenate([window[:len(run)] 
+                               for window, run in zip(windows, runs)])
     
     def get_bg_spectrum(self):
         """Collect a spectrum (experiment signal should be turned off) and
@@ -92,51 +1025,204 @@ class SdrInterface(object):
         """
         
         #in the future, add some way to automatically turn the signal generator on and off
-        self.get_samples()  
-        self.spectrum = np.roll(fft(self.time_series * self.fft_window),
-                                self.n_samples//2)
+        self.tag_captures(background=True)
+        self.acquire()
+        self.tag_captures()
+        self.spectrum = self.get_engine().centered_fft(self.time_series,
+                                                       self.fft_workers)
         self.bg_magnitude = np.abs(self.spectrum)
         return self.bg_magnitude
     
     def _nearest_ind(self, arr, val):
         return np.argmin(np.abs(arr - val))
     
-    def find_peaks(self, width=100):
+    def find_peaks(self, width=None):
         """
         Indices of peaks up to modulation_freq*max_order
         Returned as ((i_0, i_0), (i_-1, i_+1), (i_-2, i_+2), ...) where i_n is
         the nth order peak, -n is -nth order peak.
+
+        Indices are into self.magnitude, so only cover the harmonic bins if
+        the spectrum was computed in 'harmonic' mode.
+        """
+        if width is None or width == self.peak_width:
+            return self.get_analysis().peaks
+        if self.bin_indices is not None and width > self.peak_width:
+            # window is wider than the bins computed
+            self.compute_spectrum(self.subtract_bg, full=True)
+        return self.peak_indices(self.freqs, self.magnitude, width)
+
+    def get_analysis(self):
         """
+        SpectrumAnalysis of the current spectrum. It is computed on first
+        use and reused until a new spectrum is acquired or one of the
+        analysis parameters (see analysis_key) changes.
+        """
+        key = self.analysis_key()
+        if self._analysis is None or self._analysis.key != key:
+            # Peaks may already have been found with the spectrum
+            if self._peaks is not None and self._peaks[0] == key[:3]:
+                peaks = self._peaks[1]
+            else:
+                peaks = self.peak_indices(self.freqs, self.magnitude, 
+                                          self.peak_width)
+            self._analysis = SpectrumAnalysis(self, key, peaks)
+        return self._analysis
+
+    def peak_indices(self, freqs, magnitude, width):
+        """find_peaks on the given arrays, without touching any state."""
+        with self.timer.stage('peaks'):
+            return self._peak_indices(freqs, magnitude, width)
+
+    def _peak_indices(self, freqs, magnitude, width):
+        """peak_indices, untimed."""
         max_order = self.max_order
         orders = np.arange(-max_order, max_order + 1)
-        fis = [self._nearest_ind(i * self.modulation_freq, self.freqs) 
+        fis = [self._nearest_ind(i * self.modulation_freq, freqs) 
                for i in orders]
-        mag = self.magnitude
+        mag = magnitude
         mi = [fi - width + np.argmax(mag[fi-width:fi+width]) for fi in fis]
         return np.array([(mi[max_order - i], mi[max_order + i]) 
                          for i in range(max_order + 1)])
+
+    def find_tone_peaks(self, tone_freqs, width=None):
+        """
+        find_peaks for a list of tones (e.g. a multi-tone excitation) 
+        rather than the harmonics of modulation_freq: the 0th order peak
+        and the first order peaks of every tone, searched within width
+        (default peak_width) bins of -f and +f.
+
+        Returns i_0 and an (n_tones, 2) array of (i_-f, i_+f), indices into
+        the full spectrum.
+        """
+        if width is None:
+            width = self.peak_width
+        # The tones are not in the harmonic bins
+        if self.bin_indices is not None:
+            self.compute_spectrum(self.subtract_bg, full=True)
+        return self.tone_peak_indices(self.freqs, self.magnitude, tone_freqs,
+                                      width)
+
+    def tone_peak_indices(self, freqs, magnitude, tone_freqs, width):
+        """find_tone_peaks on the given arrays, without touching any state.
+        All the tones are searched at once."""
+        with self.timer.stage('peaks'):
+            tone_freqs = np.asarray(tone_freqs, dtype=float)
+            targets = np.concatenate(([0], -tone_freqs, tone_freqs))
+            # Nearest bin of each target (freqs is increasing)
+            fis = np.clip(np.searchsorted(freqs, targets), 1, len(freqs) - 1)
+            fis -= targets - freqs[fis - 1] < freqs[fis] - targets
+            starts = np.clip(fis - width, 0, len(freqs) - 2 * width)
+            windows = starts[:, None] + np.arange(2 * width)
+            mi = starts + np.argmax(magnitude[windows], axis=1)
+        return mi[0], mi[1:].reshape(2, -1).T
+
+    def tone_ratios(self, tone_freqs, width=None):
+        """
+        Ratio of each tone's first order peaks (mean of -f and +f) to the
+        0th order peak, see find_tone_peaks.
+        """
+        i0, ipeaks = self.find_tone_peaks(tone_freqs, width)
+        heights = self.peak_heights(self.magnitude, ipeaks)
+        height0 = self.peak_heights(self.magnitude, np.array([i0]))[0]
+        return heights.mean(axis=1) / height0
+
+    def get_tone_d33(self, tone_freqs, tone_voltages, width=None):
+        """
+        d33, speed and displacement (SI units) at each tone of a multi-tone
+        excitation, from tone_ratios. Each tone is taken as a small
+        modulation of its own, as the first harmonic of get_d33_spe_disp.
+
+        Args:
+            tone_freqs (array): frequency of each tone (Hz)
+            tone_voltages (array): peak to peak voltage of each tone
+            width (int): peak search width in bins (default peak_width)
+        """
+        return self.tone_d33_from_ratios(
+                self.tone_ratios(tone_freqs, width), tone_freqs, 
+                tone_voltages)
+
+    def tone_d33_from_ratios(self, ratios, tone_freqs, tone_voltages):
+        """get_tone_d33 for the given tone_ratios."""
+        tone_freqs = np.asarray(tone_freqs, dtype=float)
+        speed = tone_freqs * LAMBDA_HENE * ratios
+        disp = speed / (2 * np.pi * tone_freqs)
+        d33 = disp / (np.asarray(tone_voltages) / 2)
+        return d33, speed, disp
+
+    def discard_samples(self):
+        """
+        Make sure the next spectrum only uses samples acquired after this
+        call, e.g. after moving the stage or changing the bias. Blocking
+        backends always acquire fresh samples, so this does nothing.
+        """
+        pass
     
     def plot_spectrum(self, ax, add_labels=True, add_peaks = True, show_bg = False,
                       **plot_kwargs):
+        """
+        Plot the spectrum (in dB) around the harmonics up to max_order.
+
+        Only the visible range is plotted, reduced to its min/max in each
+        pixel column (see envelope), so it looks the same as plotting every
+        bin but draws in milliseconds. The lines are reused on the next
+        call on the same ax, so don't clear it in between.
+        """
         # Acquire data if none acquired yet
         if not hasattr(self, 'magnitude'):
             self.get_spectrum()
-        m_db = 20 * np.log10(self.magnitude)
-        ax.plot(self.freqs/1e3, m_db, 'g-', **plot_kwargs)
+        # Only the harmonic bins were computed
+        if self.bin_indices is not None:
+            self.compute_spectrum(self.subtract_bg, full=True)
+        m_db = self._db('spectrum', self.magnitude)
         xlim = (float(self.max_order)+1.1) * self.modulation_freq/1e3
+        freqs_khz = self.freqs/1e3
+        n_pixels = max(int(ax.get_window_extent().width), 100)
+        self._plot_line(ax, 'spectrum', *envelope(freqs_khz, m_db, -xlim, 
+                                                  xlim, n_pixels),
+                        'g-', **plot_kwargs)
         ax.set_xlim(-xlim, xlim)
         
         if add_peaks:
             ipeaks = self.find_peaks().flatten()
-            ax.plot(self.freqs[ipeaks]/1e3, m_db[ipeaks], 'r*')
+            self._plot_line(ax, 'peaks', freqs_khz[ipeaks], m_db[ipeaks], 
+                            'r*')
         if add_labels:
             ax.set_xlabel('f (kHz)')
             ax.set_ylabel('dB')
         if show_bg:
-            bg_db = 20 * np.log10(self.bg_magnitude)
-            ax.plot(self.freqs/1e3, bg_db, 'k-', alpha = 0.5)
+            bg_db = self._db('bg', self.bg_magnitude)
+            self._plot_line(ax, 'bg', *envelope(freqs_khz, bg_db, -xlim, 
+                                                xlim, n_pixels),
+                            'k-', alpha = 0.5)
+        for name, line in self._plot_lines.items():
+            line.set_visible(name == 'spectrum' or 
+                             (name == 'peaks' and add_peaks) or 
+                             (name == 'bg' and show_bg))
+        ax.relim(visible_only=True)
+        ax.autoscale_view(scalex=False)
 
         return self.freqs, self.magnitude, self.phase
+
+    def _db(self, name, magnitude):
+        """20 log10(magnitude), cached until magnitude is a new array."""
+        cached = self._db_cache.get(name)
+        if cached is None or cached[0] is not magnitude:
+            cached = self._db_cache[name] = (magnitude, 
+                                             20 * np.log10(magnitude))
+        return cached[1]
+
+    def _plot_line(self, ax, name, x, y, fmt, **plot_kwargs):
+        """Plot x, y as the line called name on ax, reusing the Line2D
+        from the last plot_spectrum if it is still on ax."""
+        line = self._plot_lines.get(name)
+        if line is None or line.axes is not ax or line not in ax.lines:
+            line, = ax.plot(x, y, fmt, **plot_kwargs)
+            self._plot_lines[name] = line
+        else:
+            line.set_data(x, y)
+            line.set(**plot_kwargs)
+        return line
     
     def peak_ratios(self, avg_posneg=True):
         """
@@ -146,24 +1232,44 @@ class SdrInterface(object):
         Returns (peak1/peak0, peak2/peak0, ...) if avg_posneg = true.
         Returns ((peak-1/peak0, peak1/peak0), ...) if avg_posneg = false.
         """
-        ipeaks = self.find_peaks()
-        peak0 = self.magnitude[ipeaks[0][0]]
-        peakratios = self.magnitude[ipeaks[1:]] / peak0
+        analysis = self.get_analysis()
+        if avg_posneg:
+            return analysis.ratios
+        else:
+            return analysis.posneg_ratios
+
+    def ratios_from_peaks(self, magnitude, ipeaks, avg_posneg=True):
+        """peak_ratios for the given magnitude and peak indices."""
+        heights = self.peak_heights(magnitude, ipeaks)
+        peakratios = heights[1:] / heights[0][0]
         if avg_posneg:
             return np.mean(peakratios, axis=1)
         else:
             return peakratios
     
+    def peak_heights(self, magnitude, ipeaks):
+        """Heights of the peaks at ipeaks (all harmonics at once), as set
+        by set_peak_estimation."""
+        if self.peak_estimation == 'bin':
+            return magnitude[ipeaks]
+        ipeaks = np.clip(ipeaks, 1, len(magnitude) - 2)
+        return interpolate_peaks(magnitude[ipeaks - 1], magnitude[ipeaks],
+                                 magnitude[ipeaks + 1])[1]
+
     def get_sample_speed(self):
         """Calculate the speed amplitude of the sample from 
         the peak ratios, in SI units.
         
         Returns array of speeds at each harmonic
         """
-        lambda_hene = 632.8e-9 #hene laser wavelength
-        peakratios = self.peak_ratios()
-        mod_freqs = (1 + np.arange(self.max_order)) * self.modulation_freq
-        speed = mod_freqs * lambda_hene * peakratios
+        return self.get_analysis().speed
+
+    def speed_from_ratios(self, peakratios):
+        """get_sample_speed for the given peak ratios (harmonics along the
+        last axis)."""
+        mod_freqs = ((1 + np.arange(np.shape(peakratios)[-1])) 
+                     * self.modulation_freq)
+        speed = mod_freqs * LAMBDA_HENE * peakratios
         
         return speed
     
@@ -173,10 +1279,15 @@ class SdrInterface(object):
         
         Returns array of displacement at each harmonic
         """
-        speed = self.get_sample_speed()
+        return self.get_analysis().displacement
+
+    def displacement_from_speed(self, speed):
+        """get_sample_displacement for the given speeds (harmonics along 
+        the last axis)."""
         #extra factor of 2pi comes from velocity integration, while in
         #get_sample_speed, only a ratio of frequencies was needed
-        mod_freqs = (1 + np.arange(len(speed))) * self.modulation_freq
+        mod_freqs = ((1 + np.arange(np.shape(speed)[-1])) 
+                     * self.modulation_freq)
         displacement = speed/(2*np.pi*mod_freqs)
         
         return displacement
@@ -186,14 +1297,47 @@ class SdrInterface(object):
                 
         Returns total d33, and an array of d33 values from individual harmonics
         """
-        dis = self.get_sample_displacement()
+        analysis = self.get_analysis()
+        return analysis.total_d33, analysis.d33
+
+    def d33_from_displacement(self, dis):
+        """get_d33 for the given displacements (harmonics along the last
+        axis)."""
         ampl_v = self.ppk_voltage / 2
         rms_v = ampl_v / np.sqrt(2)
-        rms_dis = np.sqrt(np.sum(dis**2) / 2)
+        rms_dis = np.sqrt(np.sum(dis**2, axis=-1) / 2)
         total_d33 = rms_dis / rms_v
         d33 = dis / ampl_v
         
         return total_d33, d33
+
+    def get_statistics(self):
+        """
+        Mean and standard error of the peak ratios and total d33 over the
+        spectra averaged by the last get_spectrum (see set_averaging).
+
+        Returns d33_mean, d33_sem, ratios_mean, ratios_sem. The errors are
+        nan for a single spectrum.
+        """
+        ratio_samples = self.ratio_samples
+        if ratio_samples is None:
+            ratio_samples = self.peak_ratios()[None, :]
+        return self.statistics_from_ratios(ratio_samples)
+
+    def statistics_from_ratios(self, ratio_samples):
+        """get_statistics for the given per-spectrum peak ratios."""
+        d33_samples = self.d33_from_displacement(
+                self.displacement_from_speed(
+                        self.speed_from_ratios(ratio_samples)))[0]
+        n = len(ratio_samples)
+        if n > 1:
+            ratios_sem = np.std(ratio_samples, axis=0, ddof=1) / np.sqrt(n)
+            d33_sem = np.std(d33_samples, ddof=1) / np.sqrt(n)
+        else:
+            ratios_sem = np.full(ratio_samples.shape[1], np.nan)
+            d33_sem = np.nan
+        return (np.mean(d33_samples), d33_sem, 
+                np.mean(ratio_samples, axis=0), ratios_sem)
     
     def get_d33_spe_disp(self):
         """Get d33, speed, displacement"""
@@ -201,15 +1345,41 @@ class SdrInterface(object):
                 self.get_sample_displacement()[0])
         
         ####NEEDS TESTING####
-    def get_phase(self):
+    def get_phase(self, method='fft'):
         """Calculates the phase of the absolute phase of the velocity
         
-        returns array of phase of each harmonic """
-        ipeaks = self.find_peaks()
-        theta = self.phase[ipeaks]
-        theta_tot = np.abs(theta[:,0]-theta[:,1])%np.pi
-        
-        return 0.5*theta_tot
+        returns array of phase of each harmonic. With method='demod', the
+        phase of each harmonic of the displacement from demodulate, valid 
+        at large modulation depth too (0 for the 0th order, as with the 
+        fft)."""
+        if method == 'demod':
+            return np.concatenate(([0], self.demodulate().phase))
+        return self.get_analysis().phase
+
+    def demodulate(self):
+        """
+        PhaseDemodulation of the last capture: displacement, speed, d33 and
+        phase of each harmonic straight from the IQ phase (see 
+        demodulate_phase), without the small modulation index assumption 
+        of the peak ratios, and without an FFT. Raises ValueError if the 
+        modulation is too deep for the decimation (see auto_decimation, 
+        which only allows for the harmonics).
+        """
+        time_series = self.time_series
+        if self.decimation > 1:
+            # Drop the filter's start up transient (see decimate), where
+            # the phase is meaningless
+            transient = len(decimation_taps(self.decimation)) 
+            time_series = time_series[transient // self.decimation:]
+        demodulation = PhaseDemodulation(self, time_series)
+        # Sidebands beyond the passband are lost, which shrinks the 
+        # modulation index
+        if demodulation.bandwidth > self.passband():
+            raise ValueError(
+                    'Modulation bandwidth (%g Hz) is beyond the passband '
+                    '(%g Hz), lower the decimation' 
+                    % (demodulation.bandwidth, self.passband()))
+        return demodulation
     
             ####NEEDS TESTING####
     def check_phase(self):
@@ -218,11 +1388,7 @@ class SdrInterface(object):
         
         returns list of of distances of phase, for each harmonic. The closer to
         zero, the better"""
-        ipeaks = self.find_peaks()
-        theta = self.phase[ipeaks]
-        theta_tot = np.abs(theta[:,0]+theta[:,1])%np.pi
-        
-        return 0.5*(theta_tot-theta_tot[0])
+        return self.get_analysis().phase_check
 
             ####NEEDS TESTING####
     def check_mag(self):
@@ -237,14 +1403,27 @@ class SdrInterface(object):
         
         return diffs
     
-                ####NEEDS FINISHING AND TESTING####
     def check_point(self):
         """Checks that the peaks are above the noise floor
         
-        returns list of heights above the noise floor"""
-        
-        #not done obviously, use histogram of points to determine if peak is
-        #above noise floor or not
+        returns heights over the noise floor (signal to noise amplitude 
+        ratios) of the peaks, shaped like find_peaks"""
+        return self.get_analysis().snr
+
+    def noise_floor(self, magnitude, ipeaks):
+        """
+        Robust noise floor around each peak at ipeaks (all at once): the 
+        median of the peak_width bins either side, leaving out the main 
+        lobe, so the peak itself and stray spurs don't count. Scaled from
+        the median to the mean of the (Rayleigh distributed) noise 
+        magnitude.
+        """
+        offsets = np.arange(-self.peak_width, self.peak_width + 1)
+        offsets = offsets[np.abs(offsets) > MAIN_LOBE_BINS]
+        indices = np.clip(np.asarray(ipeaks)[..., None] + offsets, 0, 
+                          len(magnitude) - 1)
+        return (np.median(magnitude[indices], axis=-1)
+                * np.sqrt(np.pi / (4 * np.log(2))))
         
     def close(self):
         """Close hardware connection to sdr."""
@@ -253,17 +1432,35 @@ class SdrInterface(object):
 
 class RtlSdrInterface(SdrInterface):
     """Interface to RtlSdr."""
+    # Samples read and dropped after retuning, while the tuner settles
+    settle_samples = 2**14
+    # Samples per async read of an extended capture (a multiple of 256)
+    extension_chunk = 2**14
+
     def __init__(self, center_freq, sample_freq, n_samples, modulation_freq,
-                 ppk_voltage, max_order, gain_level=0):
-        self.sdr = RtlSdr()
+                 ppk_voltage, max_order, gain_level=0, analysis_mode='full',
+                 device_index=0):
+        """
+        Args:
+            device_index (int): which dongle, when there are several (see
+                sdr_pool.SdrPool)
+        """
+        # Imported here so the analysis works without the dongle driver
+        from rtlsdr import RtlSdr
+        self.sdr = RtlSdr(device_index)
+        self.streaming = False
+        # One condition for every stream, so readers waiting on a stream
+        # that gets stopped (or restarted) are woken
+        self._latest_cond = threading.Condition()
         self.set_gain_level(gain_level)
         super().__init__(center_freq, sample_freq, n_samples, modulation_freq,
-             ppk_voltage, max_order)
+             ppk_voltage, max_order, analysis_mode)
         
     def set_center_freq(self, center_freq):
         """Set demodulator center freq."""
         self.center_freq = center_freq
         self.sdr.center_freq = center_freq
+        self.discard_samples()
         pass
     
     def set_voltage(self, ppk_voltage):
@@ -278,36 +1475,472 @@ class RtlSdrInterface(SdrInterface):
         self.sdr.max_order = max_order
         pass
     
+    def configure(self, **settings):
+        """
+        See SdrInterface.configure. A stream is restarted at most once for
+        the whole batch, and after a tuner change one shot reads drop
+        settle_samples first.
+        """
+        # ('auto' decimation restarts by itself, if it changes)
+        restart = self.streaming and any(
+                settings.get(name, 'auto') not in ('auto', getattr(self, name))
+                for name in ('sample_freq', 'n_samples', 'decimation'))
+        if restart:
+            self.stop_streaming()
+        try:
+            change = super().configure(**settings)
+        finally:
+            if restart:
+                self.start_streaming(self._n_buffers, self._chunk_samples)
+        if change.settle and not self.streaming:
+            self.sdr.read_samples(self.settle_samples)
+        return change
+
     def set_sample_freq(self, sample_freq):
         """Set sampling freq."""
+        streaming = self.streaming
+        self.stop_streaming()
         self.sample_freq = sample_freq
         self.sdr.sample_rate = sample_freq
+        if streaming:
+            self.start_streaming(self._n_buffers, self._chunk_samples)
         pass
     
     def set_n_samples(self, n_samples):
         """Set sampling freq."""
+        # The ring buffers are sized to n_samples
+        streaming = self.streaming
+        self.stop_streaming()
         self.n_samples = n_samples
-        self.fft_window = signal.blackmanharris(n_samples, sym=False)
+        self.fft_window = blackmanharris_window(n_samples)
+        if streaming:
+            self.start_streaming(self._n_buffers, self._chunk_samples)
         pass
 
     def get_samples(self):
-        """Get N samples."""
+        """Get N samples (already decimated when streaming)."""
+        if self.streaming:
+            self._take_block()
+            return self.time_series
         self.time_series = self.sdr.read_samples(self.n_samples)
         return self.time_series
+
+    def acquire(self):
+        """When streaming, the capture thread has already decimated the 
+        samples."""
+        if not self.streaming:
+            return super().acquire()
+        with self.timer.stage('samples'):
+            self._take_block()
+        self._record(self.time_series)
+        return self.time_series
+
+    def set_decimation(self, factor):
+        """See SdrInterface.set_decimation."""
+        # The ring buffers are sized to the decimated capture
+        streaming = self.streaming
+        self.stop_streaming()
+        super().set_decimation(factor)
+        if streaming:
+            self.start_streaming(self._n_buffers, self._chunk_samples)
+        pass
+
+    def acquire_block(self, full=True):
+        """
+        Acquire and analyse samples. When streaming, this is the latest
+        block the consumer thread has finished analysing (waiting for one if
+        needed).
+        """
+        if not self.streaming:
+            return super().acquire_block(full)
+        # The analysis overlapped the capture on the consumer thread, so
+        # only the wait for it shows in the timing
+        with self.timer.stage('samples'):
+            block = self._take_block()
+        self._record(self.time_series)
+        if (block['bin_indices'] is None) != full:
+            block = self.analyse(block['block'], full)
+        return block
     
+    def get_captures(self):
+        """
+        Acquire raw captures for one point. When streaming these are 
+        copied, since the ring buffers get reused.
+        """
+        captures = super().get_captures()
+        if self.streaming:
+            captures = [capture.copy() for capture in captures]
+        return captures
+    
+    def start_extended_capture(self, max_samples):
+        """
+        Read up to max_samples contiguous samples in the background, as 
+        one shot reads would leave gaps between the pieces. Streaming is
+        paused until stop_extended_capture.
+        """
+        self._resume_streaming = self.streaming
+        self.stop_streaming()
+        self._extension = np.empty(max_samples, dtype=complex)
+        self._extension_filled = 0
+        self._extension_taken = 0
+        self._extension_cancelled = False
+        self._extension_cond = threading.Condition()
+        self._extension_thread = threading.Thread(
+                target=self.sdr.read_samples_async,
+                args=(self._on_extension, self.extension_chunk), daemon=True)
+        self._extension_thread.start()
+
+    def _on_extension(self, samples, context):
+        """Async read callback: append a chunk to the extended capture."""
+        with self._extension_cond:
+            if self._extension_cancelled:
+                return
+            start = self._extension_filled
+            n = min(len(samples), len(self._extension) - start)
+            self._extension[start:start + n] = samples[:n]
+            self._extension_filled += n
+            if self._extension_filled == len(self._extension):
+                self._cancel_extension()
+            self._extension_cond.notify_all()
+
+    def _cancel_extension(self):
+        """Stop the async read, once (cancelling a finished read is an 
+        error). Call with _extension_cond held."""
+        if not self._extension_cancelled:
+            self._extension_cancelled = True
+            self.sdr.cancel_read_async()
+
+    def extend_capture(self, n_samples):
+        """See SdrInterface.extend_capture. Waits for the samples."""
+        start = self._extension_taken
+        # Generous, in case the dongle stopped delivering
+        timeout = 1 + 2 * (start + n_samples) / self.sample_freq
+        with self._extension_cond:
+            if not self._extension_cond.wait_for(
+                    lambda: self._extension_filled >= start + n_samples, 
+                    timeout):
+                raise RuntimeError('Timed out waiting for samples')
+        self._extension_taken += n_samples
+        return self._extension[start:start + n_samples]
+
+    def stop_extended_capture(self):
+        """See SdrInterface.stop_extended_capture. Resumes streaming."""
+        with self._extension_cond:
+            self._cancel_extension()
+        self._extension_thread.join()
+        self._extension = None
+        if self._resume_streaming:
+            self.start_streaming(self._n_buffers, self._chunk_samples)
+
     def set_gain_level(self, gain_level):
         """
         Set gain level to value from RtlSdr.valid_gains_db. 
         `gain_level` indexes this list.
         """
+        self.gain_level = gain_level
         self.sdr.gain = self.sdr.valid_gains_db[gain_level]
+        self.discard_samples()
         pass
-    
+
+    def start_streaming(self, n_buffers=4, chunk_samples=2**16):
+        """
+        Start continuous acquisition with the async read path.
+
+        A capture thread fills a preallocated ring of n_buffers IQ buffers
+        (chunk_samples at a time, decimated on the way in if set, see
+        set_decimation) while a consumer thread windows, transforms and 
+        finds the peaks of the last completed buffer, so analysis of block
+        N overlaps capture of block N+1. One buffer each
+        is held by the capture thread, the consumer, the latest result and
+        self.time_series, so with fewer than 4 buffers blocks get dropped.
+        chunk_samples must be a multiple of 256.
+        """
+        if self.streaming:
+            return
+        self._n_buffers = n_buffers
+        self._chunk_samples = chunk_samples
+        self._block_samples = self.n_samples // self.decimation
+        self._decimator = None
+        if self.decimation > 1:
+            self._decimator = Decimator(self.decimation)
+        self._free = queue.Queue()
+        for _ in range(n_buffers):
+            self._free.put(np.empty(self._block_samples, dtype=complex))
+        self._filled = queue.Queue()
+        self._latest = None
+        self._filling = None
+        self._held = None
+        self._fill_pos = 0
+        self._restart = False
+        self._seq = 0
+        self._min_seq = 0
+        self.dropped_chunks = 0
+        self.streaming = True
+        self._consumer = threading.Thread(target=self._consume, daemon=True)
+        self._consumer.start()
+        self._capture = threading.Thread(
+                target=self.sdr.read_samples_async,
+                args=(self._on_samples, chunk_samples), daemon=True)
+        self._capture.start()
+
+    def stop_streaming(self):
+        """Stop continuous acquisition and join the worker threads."""
+        if not self.streaming:
+            return
+        self.streaming = False
+        self.sdr.cancel_read_async()
+        self._capture.join()
+        self._filled.put(None)
+        self._consumer.join()
+        # Wake readers waiting in _take_block
+        with self._latest_cond:
+            self._latest_cond.notify_all()
+
+    def discard_samples(self):
+        """
+        Restart the block being captured, and skip any block captured
+        before this call, so the next spectrum only has fresh samples (to
+        within one chunk).
+        """
+        if not self.streaming:
+            return
+        with self._latest_cond:
+            self._restart = True
+            self._min_seq = self._seq + 1
+
+    def _on_samples(self, samples, context):
+        """Async read callback: copy a chunk into the ring."""
+        if not self.streaming:
+            return
+        with self._latest_cond:
+            if self._restart:
+                self._restart = False
+                self._fill_pos = 0
+                self._seq = self._min_seq
+        if self._decimator is not None:
+            samples = self._decimator.process(samples)
+        while len(samples):
+            if self._filling is None:
+                try:
+                    self._filling = self._free.get_nowait()
+                except queue.Empty:
+                    # Consumer can't keep up, drop the chunk
+                    self.dropped_chunks += 1
+                    return
+                self._fill_pos = 0
+            n = min(len(samples), self._block_samples - self._fill_pos)
+            self._filling[self._fill_pos:self._fill_pos + n] = samples[:n]
+            self._fill_pos += n
+            samples = samples[n:]
+            if self._fill_pos == self._block_samples:
+                self._filled.put((self._seq, self._filling))
+                self._filling = None
+                with self._latest_cond:
+                    self._seq += 1
+
+    def _consume(self):
+        """Consumer thread: analyse each completed block."""
+        while True:
+            item = self._filled.get()
+            if item is None:
+                return
+            seq, block = item
+            result = self.analyse(block, self.analysis_mode == 'full')
+            result['seq'] = seq
+            result['block'] = block
+            with self._latest_cond:
+                # Nobody picked up the previous result, recycle its buffer
+                if self._latest is not None:
+                    self._free.put(self._latest['block'])
+                self._latest = result
+                self._latest_cond.notify_all()
+
+    def _take_block(self):
+        """
+        Wait for an analysed block newer than the last one taken and at
+        least as new as the last discard_samples, and make its samples
+        self.time_series. Raises RuntimeError if streaming stops (or is
+        restarted, e.g. by set_n_samples) in the meantime.
+        """
+        with self._latest_cond:
+            self._latest_cond.wait_for(
+                    lambda: (not self.streaming or (
+                             self._latest is not None 
+                             and self._latest['seq'] >= self._min_seq)))
+            if not self.streaming:
+                raise RuntimeError('Streaming stopped while waiting for '
+                                   'samples')
+            result = self._latest
+            self._latest = None
+            self._min_seq = result['seq'] + 1
+        # Hand the previous block back to the capture thread
+        if self._held is not None:
+            self._free.put(self._held)
+        self._held = result['block']
+        self.time_series = result['block']
+        return result
     
     def close(self):
         """Close hardware connection to sdr."""
+        self.stop_streaming()
+        self.stop_recording()
         self.sdr.close()
         
+class SimulatedSdrInterface(SdrInterface):
+    """
+    SdrInterface that synthesizes LDV IQ data instead of reading hardware:
+    a carrier phase modulated at modulation_freq (and its harmonics) by the
+    sample displacement, plus complex noise and a DC offset. Use it to
+    exercise, benchmark and regression test the analysis without the 
+    dongle.
+    """
+    def __init__(self, center_freq, sample_freq, n_samples, modulation_freq,
+                 ppk_voltage, max_order, displacement=1e-10, harmonics=(),
+                 noise_level=1e-3, dc_offset=0, carrier_freq=0,
+                 realtime_rate=None, block_samples=2**16, seed=None,
+                 analysis_mode='full'):
+        """
+        Args:
+            displacement (float): displacement amplitude (m) at 
+                modulation_freq
+            harmonics (list): displacement amplitudes (m) at 2, 3, ... 
+                times modulation_freq
+            noise_level (float): rms of the complex noise, relative to the
+                carrier amplitude
+            dc_offset (complex): added to every sample
+            carrier_freq (float): carrier offset from center_freq (Hz)
+            realtime_rate (float): if set, get_samples takes
+                n_samples / (sample_freq * realtime_rate) seconds, like 
+                hardware would at realtime_rate=1. None is as fast as 
+                possible.
+            block_samples (int): samples generated per block
+            seed (int): random seed for the noise
+        """
+        self.set_displacement(displacement, harmonics)
+        self.noise_level = noise_level
+        self.dc_offset = dc_offset
+        self.carrier_freq = carrier_freq
+        self.realtime_rate = realtime_rate
+        self.block_samples = block_samples
+        self.rng = np.random.default_rng(seed)
+        self.gain_level = 0
+        self._sample_index = 0
+        self._deadline = None
+        super().__init__(center_freq, sample_freq, n_samples, modulation_freq,
+             ppk_voltage, max_order, analysis_mode)
+
+    def set_displacement(self, displacement, harmonics=()):
+        """Set the simulated displacement amplitudes (m), fundamental
+        first."""
+        self.displacement = displacement
+        self.harmonics = list(harmonics)
+        pass
+
+    def set_gain_level(self, gain_level):
+        """Set gain level. Only stored, the simulation has no tuner."""
+        self.gain_level = gain_level
+        pass
+
+    def modulation_indices(self):
+        """Phase modulation index of each harmonic, 4 pi d / lambda for a
+        reflected beam."""
+        amplitudes = np.array([self.displacement] + self.harmonics)
+        return 4 * np.pi * amplitudes / LAMBDA_HENE
+
+    def get_samples(self):
+        """Synthesize n_samples, continuing the phase of the last call."""
+        time_series = np.empty(self.n_samples, dtype=complex)
+        betas = self.modulation_indices()
+        orders = 1 + np.arange(len(betas))
+        for start in range(0, self.n_samples, self.block_samples):
+            stop = min(start + self.block_samples, self.n_samples)
+            t = ((self._sample_index + np.arange(start, stop)) 
+                 / self.sample_freq)
+            phase = 2 * np.pi * self.carrier_freq * t
+            phase = phase + betas @ np.sin(
+                    2 * np.pi * self.modulation_freq * np.outer(orders, t))
+            noise = self.rng.standard_normal((stop - start, 2)) @ [1, 1j]
+            time_series[start:stop] = (np.exp(1j * phase) + self.dc_offset
+                    + noise * self.noise_level / np.sqrt(2))
+        self._sample_index += self.n_samples
+        self._wait_realtime()
+        self.time_series = time_series
+        return self.time_series
+
+    def _wait_realtime(self):
+        """Sleep so captures come no faster than realtime_rate allows."""
+        if not self.realtime_rate:
+            return
+        duration = self.n_samples / (self.sample_freq * self.realtime_rate)
+        now = time.perf_counter()
+        if self._deadline is None or self._deadline < now:
+            self._deadline = now
+        self._deadline += duration
+        time.sleep(max(0, self._deadline - now))
+
+
+class ReplaySdrInterface(SdrInterface):
+    """
+    SdrInterface that serves the captures of a raw IQ recording (see
+    SdrInterface.start_recording) in order, straight from a memory map, so
+    whole sweeps can be reanalysed with different max_order, peak_width,
+    averaging etc. without hardware and without loading them into RAM.
+    """
+    def __init__(self, path, max_order, analysis_mode='full', loop=False):
+        """
+        Args:
+            path (str): recording directory
+            max_order (int): highest harmonic to analyse
+            loop (bool): if true, start over after the last capture,
+                otherwise get_samples raises IndexError
+        
+        The other settings come from each capture's metadata.
+        """
+        self.path = path
+        self.loop = loop
+        self.index = read_iq_index(path)
+        self.iq = open_iq(path)
+        self.capture_index = 0
+        first = self.index[0]
+        super().__init__(first['center_freq'], first['sample_freq'], 
+                         first['n_samples'], first['modulation_freq'],
+                         first['ppk_voltage'], max_order, analysis_mode)
+        self.capture_info = first
+
+    def __len__(self):
+        """Number of captures in the recording."""
+        return len(self.index)
+
+    def seek(self, capture_index):
+        """Serve capture_index next."""
+        self.capture_index = capture_index
+
+    def set_gain_level(self, gain_level):
+        """Gain is fixed by the recording, so only stored."""
+        self.gain_level = gain_level
+        pass
+
+    def get_samples(self):
+        """Next capture, a read only view of the memory map. Applies the 
+        settings it was recorded with."""
+        if self.capture_index >= len(self.index):
+            if not self.loop:
+                raise IndexError('No more captures in ' + self.path)
+            self.capture_index = 0
+        info = self.index[self.capture_index]
+        self.capture_index += 1
+        self.capture_info = info
+        self.set_center_freq(info['center_freq'])
+        self.set_sample_freq(info['sample_freq'])
+        self.set_modulation_freq(info['modulation_freq'])
+        self.set_voltage(info['ppk_voltage'])
+        if info['n_samples'] != self.n_samples:
+            self.set_n_samples(info['n_samples'])
+        self.time_series = self.iq[info['offset']:
+                                   info['offset'] + info['n_samples']]
+        return self.time_series
+
+
 if __name__ == '__main__':
     import matplotlib.pyplot as plt
     center_freq = 40e6
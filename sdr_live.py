@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:05:37 2026
+
+@author: rzchlab
+
+Continuous spectrum acquisition for the live view on the SDR tab: an
+exponentially averaged spectrum and a rolling waterfall, updated by a
+worker thread and read by the GUI at its own frame rate.
+"""
+
+import threading
+import numpy as np
+from sdr_interface import envelope
+
+
+class LiveSpectrum(object):
+    def __init__(self, sdr, alpha=0.3, n_rows=200, n_columns=800):
+        """
+        Acquire spectra continuously with sdr.get_spectrum.
+
+        Args:
+            sdr (SdrInterface)
+            alpha (float): weight of each new spectrum in the exponential
+                average (1 for no averaging)
+            n_rows (int): spectra kept in the waterfall ring buffer
+            n_columns (int): frequency columns of the waterfall
+        """
+        self.sdr = sdr
+        self.alpha = alpha
+        self.n_rows = n_rows
+        self.n_columns = n_columns
+        self.thread = None
+        self.running = False
+        self.error = None
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget the average and the waterfall."""
+        with self._lock:
+            self.average = None
+            self.waterfall = np.full((self.n_rows, self.n_columns), np.nan)
+            self.n_frames = 0
+            self.ratios = None
+            self.d33 = np.nan
+
+    def span(self):
+        """Displayed frequency range (kHz), as in plot_spectrum."""
+        xlim = (self.sdr.max_order + 1.1) * self.sdr.modulation_freq / 1e3
+        return -xlim, xlim
+
+    def start(self):
+        """Start acquiring on a worker thread (streaming, if the sdr can)."""
+        if self.running:
+            return
+        self.reset()
+        self.error = None
+        self.running = True
+        if hasattr(self.sdr, 'start_streaming'):
+            self.sdr.start_streaming()
+        self.thread = threading.Thread(target=self._acquire, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop acquiring and wait for the last spectrum."""
+        if not self.running:
+            return
+        self.running = False
+        self.thread.join()
+        if hasattr(self.sdr, 'stop_streaming'):
+            self.sdr.stop_streaming()
+
+    def _acquire(self):
+        """Worker thread: get spectra until stopped."""
+        try:
+            while self.running:
+                freqs, magnitude, _ = self.sdr.get_spectrum()
+                ratios = self.sdr.peak_ratios()
+                d33, _ = self.sdr.get_d33()
+                self._add(freqs, magnitude, ratios, d33)
+        except Exception as e:
+            self.error = e
+            self.running = False
+
+    def _add(self, freqs, magnitude, ratios, d33):
+        """Fold a spectrum into the average and the waterfall."""
+        with self._lock:
+            if self.average is None or len(self.average) != len(magnitude):
+                self.average = magnitude.copy()
+            else:
+                self.average *= 1 - self.alpha
+                self.average += self.alpha * magnitude
+            self.freqs_khz = freqs / 1e3
+            self.waterfall[self.n_frames % self.n_rows] = self._columns(
+                    self.freqs_khz, 20 * np.log10(magnitude))
+            self.n_frames += 1
+            self.ratios = ratios
+            self.d33 = d33
+
+    def _columns(self, freqs_khz, m_db):
+        """Max of m_db in each of n_columns over the span."""
+        start, stop = np.searchsorted(freqs_khz, self.span())
+        m_db = m_db[start:stop]
+        if len(m_db) == 0:
+            return np.full(self.n_columns, np.nan)
+        starts = np.linspace(0, len(m_db), self.n_columns,
+                             endpoint=False).astype(int)
+        return np.maximum.reduceat(m_db, starts)
+
+    def snapshot(self, n_pixels=1000):
+        """
+        Copy of the current state for drawing: the averaged spectrum over
+        the span as an envelope (see sdr_interface.envelope) x (kHz), y
+        (dB), the waterfall in dB (oldest row first), the peak ratios and
+        d33 of the latest spectrum and the number of spectra so far. x and
+        y are None before the first spectrum.
+        """
+        with self._lock:
+            if self.average is None:
+                return None, None, self.waterfall.copy(), None, np.nan, 0
+            x, y = envelope(self.freqs_khz, 20 * np.log10(self.average),
+                            *self.span(), n_pixels)
+            waterfall = np.roll(self.waterfall,
+                                -(self.n_frames % self.n_rows), axis=0)
+            return (x.copy(), y, waterfall, self.ratios, self.d33,
+                    self.n_frames)
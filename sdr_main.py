@@ -5,12 +5,10 @@ Created on Thu Oct  3 13:51:02 2019
 @author: rzchlab
 """
 
-from sdr_interface import RtlSdrInterface
+from sdr_instruments import InstrumentRegistry
 from sdr_gui import SdrGUI
-from sdr_measurements import LineScan, BiasSweep, BiasSweepWithCV
-from instrpyvisa import (FuncGenAgilent33220, MotionControllerNewportESP300, 
-                         LockInAmpSrs830)
-from visa import ResourceManager
+from sdr_measurements import (LineScan, BiasSweep, BiasSweepWithCV, AreaScan,
+                              FrequencySweep)
 
 ######################
 ###      TODO      ###
@@ -18,11 +16,7 @@ from visa import ResourceManager
 """
 - Add cycles to biassweep
 - Email / text alerts?
-- Autosave data to temp files
 - Add CV loop units
-- peak heights from peak fits instead of just peak values in sdr spectra
-- allow for multiple sdr spectra per point, then take statistics
-- method for measuring when mod index isn't << 1?
 - check with laser stabilization?
     - (Should make guide for how to do this)
 
@@ -41,20 +35,54 @@ LIA_ADDRESS = 9
 ### INITIALIZATION ###
 ######################
 
-rm = ResourceManager()
-fg = FuncGenAgilent33220(FG_ADDRESS, rm)
-mc = MotionControllerNewportESP300(MC_ADDRESS, rm)
-sdr = RtlSdrInterface(40e6, 2.048e6, 512**2, 30e3, 1, 1)
-lia = LockInAmpSrs830(LIA_ADDRESS, rm)
+# The drivers are imported in the factories, and the instruments connect 
+# in the background while the GUI comes up (see sdr_instruments)
+
+def open_rm():
+    from visa import ResourceManager
+    return ResourceManager()
+
+def open_fg():
+    from instrpyvisa import FuncGenAgilent33220
+    return FuncGenAgilent33220(FG_ADDRESS, instruments.get('rm'))
+
+def open_mc():
+    from instrpyvisa import MotionControllerNewportESP300
+    return MotionControllerNewportESP300(MC_ADDRESS, instruments.get('rm'))
+
+def open_sdr():
+    from sdr_interface import RtlSdrInterface
+    return RtlSdrInterface(40e6, 2.048e6, 512**2, 30e3, 1, 1)
+
+def open_lia():
+    from instrpyvisa import LockInAmpSrs830
+    return LockInAmpSrs830(LIA_ADDRESS, instruments.get('rm'))
+
+instruments = InstrumentRegistry()
+instruments.register('rm', open_rm)
+instruments.register('fg', open_fg)
+instruments.register('mc', open_mc)
+instruments.register('sdr', open_sdr)
+instruments.register('lia', open_lia)
+instruments.connect_all()
+
+fg = instruments.proxy('fg')
+mc = instruments.proxy('mc')
+sdr = instruments.proxy('sdr')
+lia = instruments.proxy('lia')
 
 linescan = LineScan(sdr, fg, mc)
 biassweep = BiasSweep(sdr, fg)
 biassweepcv = BiasSweepWithCV(sdr, fg, lia)
+freqsweep = FrequencySweep(sdr, fg)
+areascan = AreaScan(sdr, fg, mc)
 
 
 ######################
 ###      MAIN      ###
 ######################
 
-gui = SdrGUI(sdr, fg, mc, lia, linescan, biassweep, biassweepcv)
-gui.dmain.show()
\ No newline at end of file
+gui = SdrGUI(sdr, fg, mc, lia, linescan, biassweep, biassweepcv, areascan,
+             instruments, freqsweep)
+gui.dmain.show()
+instruments.close_all()
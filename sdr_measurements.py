@@ -5,10 +5,163 @@ Created on Mon Oct 14 16:19:15 2019
 @author: rzchlab
 """
 
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, wait
+import os
+import queue
+import threading
+import time
 import numpy as np
+from sdr_storage import ResultTable, ResultWriter, load_results
+from sdr_timing import (SDR_STAGES, point_times, save_timing_report,
+                        timing_columns, timing_report)
+
+
+class MeasurementAborted(Exception):
+    """Raised out of a measurement's run when it is aborted."""
+
+
+class InstrumentExecutor(object):
+    """
+    Reads several instruments at once for one point, e.g. the sdr capture
+    and a lock-in over GPIB, so the slower one sets the time per point 
+    instead of their sum. The worker threads are kept for every point.
+    """
+    def __init__(self, max_workers=4):
+        """
+        Args:
+            max_workers (int): extra instruments read at the same time
+        """
+        self.max_workers = max_workers
+        self.pool = None
+
+    def run(self, *calls, timer=None):
+        """
+        Call each of calls (functions of no arguments) at the same time,
+        the first on this thread and the others on the workers, and wait
+        for all of them.
+
+        Args:
+            timer (StageTimer): if given, the stage times of the worker 
+                calls are added to this thread's point
+
+        Returns their results, in order. If any raises, the first error is
+        raised once all of them are done.
+        """
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.max_workers,
+                                           thread_name_prefix='instrument')
+        futures = [self.pool.submit(_timed_call, call, timer) 
+                   for call in calls[1:]]
+        try:
+            results = [calls[0]()]
+        finally:
+            # Nothing is left reading into the next point
+            wait(futures)
+        for future in futures:
+            result, times = future.result()
+            for stage, seconds in times.items():
+                timer.add(stage, seconds)
+            results.append(result)
+        return results
+
+    def close(self):
+        """Stop the worker threads."""
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+def _timed_call(call, timer):
+    """call() on an InstrumentExecutor worker, with the worker's stage 
+    times."""
+    result = call()
+    return result, timer.collect() if timer is not None else {}
+
+
+def peak_columns(max_order):
+    """Result columns of the peak ratios and the standard errors of the
+    mean, after d33, speed and disp."""
+    peakcols = ['peak%d' % (i + 1) for i in range(max_order)]
+    semcols = ['d33_sem'] + [p + '_sem' for p in peakcols]
+    return peakcols + semcols
+
+
+class Measurement(object):
+    """Abort and timing support shared by the measurements."""
+    # Timed stages of a point (see SdrInterface.set_timing), in column 
+    # order. 'total' is the whole point.
+    stages = SDR_STAGES + ('total',)
+
+    def __init__(self, sdr, cols):
+        """
+        Args:
+            sdr (SdrInterface)
+            cols (list): result columns before the peak columns
+        """
+        self.sdr = sdr
+        self.cols = cols
+        self.autosave = None
+        self.timing = None
+        self._abort = threading.Event()
+        # The peak columns depend on sdr.max_order, which may change (and
+        # the sdr may not be connected yet), so they come with each run
+        self._data = None
+
+    def peak_columns(self):
+        """Peak and sem result columns for the sdr's max_order."""
+        return peak_columns(self.sdr.max_order)
+
+    @property
+    def data(self):
+        """DataFrame of the last run's points, empty (with self.cols) 
+        before the first. Built on first use, so creating measurements 
+        doesn't import pandas."""
+        if self._data is None:
+            import pandas as pd
+            self._data = pd.DataFrame(columns=self.cols)
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
+    def abort(self):
+        """
+        Stop a run (from another thread) before its next point. The run
+        returns the stage / bias to its safe state, keeps the points so far
+        in self.data and raises MeasurementAborted.
+        """
+        self._abort.set()
+
+    def check_abort(self):
+        """Raise MeasurementAborted if abort was called."""
+        if self._abort.is_set():
+            raise MeasurementAborted()
+
+    def timing_columns(self):
+        """t_<stage> result columns, if the sdr's timing is on."""
+        return timing_columns(self.sdr.timer, self.stages)
+
+    def point_times(self, times, start):
+        """Values for timing_columns from a point's stage times and its
+        start (time.perf_counter)."""
+        times['total'] = time.perf_counter() - start
+        return point_times(self.sdr.timer, self.stages, times)
+
+    def report_timing(self):
+        """Percentiles of the stage times of the run in self.timing (see
+        sdr_timing.timing_report), None if timing is off. Also saved in 
+        the autosave store."""
+        self.timing = None
+        if self.sdr.timer.enabled:
+            self.timing = timing_report(self.data)
+        if self.timing is not None and self.autosave is not None:
+            save_timing_report(self.timing, self.autosave)
+
+
+class BiasSweep(Measurement):
+    stages = ('settle',) + SDR_STAGES + ('d33', 'total')
 
-class BiasSweep(object):
     def __init__(self, sdr, fg):
         """
         Do a bias sweep sdr measurement
@@ -17,14 +170,11 @@ class BiasSweep(object):
             sdr (SdrInterface)
             fg (FuncGen)
         """
-        self.sdr = sdr
+        Measurement.__init__(self, sdr, ['bias_v', 'd33', 'speed', 'disp'])
         self.fg = fg
-        # Don't hardcode these in case sdr.max_order changes
-        peakcols = ['peak%d' % (i + 1) for i in range(self.sdr.max_order)]
-        self.cols = ['bias_v', 'd33', 'speed', 'disp']
-        self.data = pd.DataFrame(columns=self.cols + peakcols)
 
-    def run(self, bias_voltages, back_to_zero=True):
+    def run(self, bias_voltages, back_to_zero=True, autosave=None,
+            resume=False, callback=None):
         """
         Run a bias sweep measurement.
 
@@ -34,25 +184,52 @@ class BiasSweep(object):
                 for the gain of the amplifier.
             back_to_zero (bool): If true, return bias to zero V 
                 when sweep completed.
+            autosave (str): If given, directory to append each point to
+                as it is measured (see sdr_storage).
+            resume (bool): If true, continue the interrupted sweep saved
+                in autosave instead of starting over.
+            callback (function): called as callback(row) with a dict of
+                each point as it is measured, e.g. to update a plot.
         """
-        data = []
+        self.autosave = autosave
+        self._abort.clear()
+        # Drop times left over from before the run
+        self.sdr.timer.collect()
+        table = ResultTable(self.cols + self.peak_columns() 
+                            + self.timing_columns(), 
+                            len(bias_voltages), autosave, resume, 
+                            callback=callback)
+        try:
+            self._sweep(bias_voltages[table.n_rows:], table)
+        finally:
+            table.close()
+            self.sdr.tag_captures()
+            # Return to starting postion (always zero bias if aborted)
+            if back_to_zero or self._abort.is_set():
+                self.fg.offset(0)
+            self.data = table.to_dataframe()
+            self.report_timing()
+
+    def _sweep(self, bias_voltages, table):
+        """Measure each bias point into table."""
+        timer = self.sdr.timer
         for bv in bias_voltages:
-            self.fg.offset(bv / 5)
+            self.check_abort()
+            start = time.perf_counter()
+            with timer.stage('settle'):
+                self.fg.offset(bv / 5)
+                self.sdr.discard_samples()
+            self.sdr.tag_captures(bias_v=bv)
 
             # Measure
             self.sdr.get_spectrum()
-            d33, speed, disp = self.sdr.get_d33_spe_disp()
-            peakratios = self.sdr.peak_ratios()
-            data.append([bv, d33, speed, disp, *peakratios])
-
-        # Return to starting postion
-        if back_to_zero:
-            self.fg.offset(0)
-
-        peakcols = ['peak%d' % (i + 1) for i in range(self.sdr.max_order)]
-        self.data = data
-        outdf = pd.DataFrame(data=np.array(data), columns=self.cols + peakcols)
-        self.data = outdf
+            with timer.stage('d33'):
+                d33, speed, disp = self.sdr.get_d33_spe_disp()
+                peakratios = self.sdr.peak_ratios()
+                _, d33_sem, _, ratios_sem = self.sdr.get_statistics()
+            table.append([bv, d33, speed, disp, *peakratios, 
+                          d33_sem, *ratios_sem,
+                          *self.point_times(timer.collect(), start)])
 
     def triwave(self, step, nstep, add_final_zero=True):
         """
@@ -72,54 +249,265 @@ class BiasSweep(object):
         return whole
 
 class BiasSweepWithCV(BiasSweep):
-    def __init__(self, sdr, fg, lia):
+    stages = ('settle',) + SDR_STAGES + ('lockin', 'd33', 'total')
+
+    def __init__(self, sdr, fg, lia, lockin_reads=1, concurrent=True):
         """
         Do a bias sweep sdr measurement
 
         Args:
             sdr (SdrInterface)
             fg (FuncGen)
+            lia (LockIn)
+            lockin_reads (int): lock-in reads averaged per point
+            concurrent (bool): if true, read the lock-in while the sdr 
+                captures, rather than after
         """
-        self.sdr = sdr
+        Measurement.__init__(self, sdr, ['bias_v', 'd33', 'speed', 'disp',
+                                         'r', 'theta'])
         self.fg = fg
         self.lia = lia
-        # Don't hardcode these in case sdr.max_order changes
-        peakcols = ['peak%d' % (i + 1) for i in range(self.sdr.max_order)]
-        self.cols = ['bias_v', 'd33', 'speed', 'disp', 'r', 'theta']
-        self.data = pd.DataFrame(columns=self.cols + peakcols)
+        self.lockin_reads = lockin_reads
+        self.concurrent = concurrent
+        self.executor = InstrumentExecutor(1)
 
-    def run(self, bias_voltages, back_to_zero=True):
+    def _sweep(self, bias_voltages, table):
+        """Measure each bias point into table."""
+        timer = self.sdr.timer
+        try:
+            for bv in bias_voltages:
+                self.check_abort()
+                start = time.perf_counter()
+                with timer.stage('settle'):
+                    self.fg.offset(bv / 5)
+                    self.sdr.discard_samples()
+                self.sdr.tag_captures(bias_v=bv)
+
+                # Measure
+                if self.concurrent:
+                    _, (r, theta) = self.executor.run(self.sdr.get_spectrum, 
+                                                      self.read_lockin, 
+                                                      timer=timer)
+                else:
+                    self.sdr.get_spectrum()
+                    r, theta = self.read_lockin()
+                with timer.stage('d33'):
+                    d33, speed, disp = self.sdr.get_d33_spe_disp()
+                    peakratios = self.sdr.peak_ratios()
+                    _, d33_sem, _, ratios_sem = self.sdr.get_statistics()
+                table.append([bv, d33, speed, disp, r, theta, *peakratios,
+                              d33_sem, *ratios_sem,
+                              *self.point_times(timer.collect(), start)])
+        finally:
+            # Stop the lock-in thread, the next run starts a new one
+            self.executor.close()
+
+    def read_lockin(self):
         """
-        Run a bias sweep measurement.
+        r, theta from the lock-in, averaged over lockin_reads reads (theta
+        as an angle, in degrees like the lock-in's).
+        """
+        with self.sdr.timer.stage('lockin'):
+            if self.lockin_reads == 1:
+                return self.lia.rtheta()
+            reads = np.array([self.lia.rtheta() 
+                              for _ in range(self.lockin_reads)])
+        mean_phasor = np.mean(np.exp(1j * np.radians(reads[:, 1])))
+        return reads[:, 0].mean(), np.degrees(np.angle(mean_phasor))
+
+def multitone_waveform(harmonics, n_points=2**14):
+    """
+    One period of equal sines at the given (integer) harmonics of the 
+    period, for an arbitrary waveform generator. Schroeder phases keep the
+    crest factor low, so each tone gets a good share of the generator's 
+    range.
+
+    Returns the waveform, scaled to a peak of 1, and the amplitude of each
+    tone in it.
+    """
+    harmonics = np.asarray(harmonics)
+    k = np.arange(len(harmonics))
+    phases = -np.pi * k * (k + 1) / len(harmonics)
+    t = np.arange(n_points) / n_points
+    waveform = np.sin(2 * np.pi * harmonics[:, None] * t 
+                      + phases[:, None]).sum(axis=0)
+    scale = 1 / np.max(np.abs(waveform))
+    return waveform * scale, np.full(len(harmonics), scale)
+
+class FrequencySweep(Measurement):
+    stages = ('settle',) + SDR_STAGES + ('d33', 'total')
+
+    def __init__(self, sdr, fg):
+        """
+        Measure d33 against the modulation frequency, stepping a sine 
+        through the frequencies (run) or exciting them all at once and 
+        analysing a single capture (run_multitone).
 
         Args:
-            bias_voltages (list): List of the bias voltages to
-                sweep through. The values are divided by 5 to account
-                for the gain of the amplifier.
-            back_to_zero (bool): If true, return bias to zero V 
-                when sweep completed.
+            sdr (SdrInterface)
+            fg (FuncGen): for run_multitone, it needs a 
+                setup_arb(waveform, freq, vpp, offset) that outputs one 
+                period of waveform (values in [-1, 1]) repeated at freq.
         """
-        data = []
-        for bv in bias_voltages:
-            self.fg.offset(bv / 5)
+        Measurement.__init__(self, sdr, ['freq_hz', 'd33', 'speed', 'disp'])
+        self.fg = fg
+
+    def _check_band(self, freq):
+        """Raise ValueError if freq (Hz) is beyond the sdr's passband."""
+        if freq > self.sdr.passband():
+            raise ValueError('%g Hz is beyond the sdr passband (%g Hz), '
+                             'lower the decimation' 
+                             % (freq, self.sdr.passband()))
+
+    def run(self, freqs, vpp=None, offset_v=0, multitone=False, 
+            restore=True, autosave=None, resume=False, callback=None):
+        """
+        Step a sine through freqs, measuring each as a BiasSweep point.
+
+        Args:
+            freqs (array): modulation frequencies (Hz)
+            vpp (float): peak to peak voltage at the sample (default 
+                sdr.ppk_voltage)
+            offset_v (float): bias voltage at the sample
+            multitone (bool): If true, excite and measure them all at once
+                with run_multitone instead (resume is ignored).
+            restore (bool): If true, go back to the sdr's modulation freq
+                and voltage at the end (always if aborted).
+            autosave (str): If given, directory to append each point to
+                as it is measured (see sdr_storage).
+            resume (bool): If true, continue the interrupted sweep saved
+                in autosave instead of starting over.
+            callback (function): called as callback(row) with a dict of
+                each point as it is measured, e.g. to update a plot.
+        """
+        if multitone:
+            return self.run_multitone(freqs, vpp, offset_v, restore=restore,
+                                      autosave=autosave, callback=callback)
+        if vpp is None:
+            vpp = self.sdr.ppk_voltage
+        freqs = np.asarray(freqs)
+        self._check_band(freqs.max() * self.sdr.max_order)
+        start_freq = self.sdr.modulation_freq
+        start_vpp = self.sdr.ppk_voltage
+        self.autosave = autosave
+        self._abort.clear()
+        # Drop times left over from before the run
+        self.sdr.timer.collect()
+        table = ResultTable(self.cols + self.peak_columns() 
+                            + self.timing_columns(), 
+                            len(freqs), autosave, resume, callback=callback)
+        try:
+            self._sweep(freqs[table.n_rows:], vpp, offset_v, table)
+        finally:
+            table.close()
+            self.sdr.tag_captures()
+            if restore or self._abort.is_set():
+                self.fg.setup_sin(start_freq, start_vpp / 5, offset_v / 5)
+                self.sdr.configure(modulation_freq=start_freq, 
+                                   ppk_voltage=start_vpp)
+            self.data = table.to_dataframe()
+            self.report_timing()
+
+    def _sweep(self, freqs, vpp, offset_v, table):
+        """Measure each frequency into table."""
+        timer = self.sdr.timer
+        for freq in freqs:
+            self.check_abort()
+            start = time.perf_counter()
+            with timer.stage('settle'):
+                self.fg.setup_sin(freq, vpp / 5, offset_v / 5)
+                self.sdr.configure(modulation_freq=freq, ppk_voltage=vpp)
+                self.sdr.discard_samples()
+            self.sdr.tag_captures(freq_hz=freq)
 
             # Measure
             self.sdr.get_spectrum()
-            r, theta = self.lia.rtheta()
-            d33, speed, disp = self.sdr.get_d33_spe_disp()
-            peakratios = self.sdr.peak_ratios()
-            data.append([bv, d33, speed, disp, r, theta, *peakratios])
+            with timer.stage('d33'):
+                d33, speed, disp = self.sdr.get_d33_spe_disp()
+                peakratios = self.sdr.peak_ratios()
+                _, d33_sem, _, ratios_sem = self.sdr.get_statistics()
+            table.append([freq, d33, speed, disp, *peakratios, 
+                          d33_sem, *ratios_sem,
+                          *self.point_times(timer.collect(), start)])
 
-        # Return to starting postion
-        if back_to_zero:
-            self.fg.offset(0)
+    def run_multitone(self, freqs, vpp=None, offset_v=0, n_points=2**14,
+                      width=None, restore=True, autosave=None, 
+                      callback=None):
+        """
+        Excite all of freqs at once with a multi-tone arbitrary waveform
+        and get the response at each from one spectrum. Each tone is
+        analysed as a small modulation of its own, so the first order 
+        peaks must stay well above the noise and clear of the other tones'
+        harmonics and mixing products (e.g. avoid a tone at twice, or the
+        sum of, others). The sdr should be in 'full' analysis mode, with 
+        enough bandwidth and n_samples to resolve the tones.
 
-        peakcols = ['peak%d' % (i + 1) for i in range(self.sdr.max_order)]
-        self.data = data
-        outdf = pd.DataFrame(data=np.array(data), columns=self.cols + peakcols)
-        self.data = outdf
+        Args:
+            freqs (array): tone frequencies (Hz), integer multiples of 
+                their greatest common divisor, the waveform's repetition
+                frequency.
+            vpp (float): peak to peak voltage of the whole waveform at the
+                sample (default sdr.ppk_voltage)
+            offset_v (float): bias voltage at the sample
+            n_points (int): points in the arbitrary waveform
+            width (int): peak search width in bins (default sdr.peak_width)
+            restore (bool): If true, go back to a sine at the sdr's 
+                modulation freq and voltage at the end.
+            autosave (str): If given, directory to save the result to
+                (see sdr_storage).
+            callback (function): called as callback(row) with a dict of
+                each tone.
+        """
+        if not hasattr(self.fg, 'setup_arb'):
+            raise ValueError('The function generator has no setup_arb, '
+                             'which multi-tone excitation needs')
+        if vpp is None:
+            vpp = self.sdr.ppk_voltage
+        freqs = np.asarray(freqs)
+        if np.any(freqs != np.round(freqs)):
+            raise ValueError('Tone frequencies must be whole Hz')
+        self._check_band(freqs.max())
+        rep_freq = np.gcd.reduce(freqs.astype(int))
+        harmonics = freqs.astype(int) // rep_freq
+        if 2 * harmonics.max() >= n_points:
+            raise ValueError('n_points too small for the highest tone')
+        waveform, amplitudes = multitone_waveform(harmonics, n_points)
+        tone_vpp = vpp * amplitudes
+        self.autosave = autosave
+        self._abort.clear()
+        self.sdr.timer.collect()
+        table = ResultTable(self.cols + ['tone_vpp', 'peak1'] 
+                            + self.timing_columns(), 
+                            len(freqs), autosave, callback=callback)
+        timer = self.sdr.timer
+        try:
+            start = time.perf_counter()
+            with timer.stage('settle'):
+                self.fg.setup_arb(waveform, rep_freq, vpp / 5, offset_v / 5)
+                self.sdr.discard_samples()
+            self.sdr.tag_captures(multitone=True)
+            self.check_abort()
+
+            self.sdr.get_spectrum()
+            with timer.stage('d33'):
+                ratios = self.sdr.tone_ratios(freqs, width)
+                d33, speed, disp = self.sdr.tone_d33_from_ratios(
+                        ratios, freqs, tone_vpp)
+            times = self.point_times(timer.collect(), start)
+            for row in zip(freqs, d33, speed, disp, tone_vpp, ratios):
+                table.append([*row, *times])
+        finally:
+            table.close()
+            self.sdr.tag_captures()
+            if restore or self._abort.is_set():
+                self.fg.setup_sin(self.sdr.modulation_freq, 
+                                  self.sdr.ppk_voltage / 5, offset_v / 5)
+            self.data = table.to_dataframe()
+            self.report_timing()
+
+class LineScan(Measurement):
+    stages = ('move',) + SDR_STAGES + ('d33', 'total')
 
-class LineScan(object):
     def __init__(self, sdr, fg, mc):
         """
         Do a line scan sdr measurement
@@ -129,15 +517,12 @@ class LineScan(object):
             fg (FuncGen)
             mc (MotionController)
         """
-        self.sdr = sdr
+        Measurement.__init__(self, sdr, ['loc_um', 'd33', 'speed', 'disp'])
         self.mc = mc
         self.fg = fg
-        # Don't hardcode these in case sdr.max_order changes
-        peakcols = ['peak%d' % (i + 1) for i in range(self.sdr.max_order)]
-        self.cols = ['loc_um', 'd33', 'speed', 'disp']
-        self.data = pd.DataFrame(columns=self.cols + peakcols)
 
-    def run(self, step_um, nsteps, moveaxis):
+    def run(self, step_um, nsteps, moveaxis, pipelined=False, n_workers=2,
+            autosave=None, resume=False, callback=None):
         """
         Run a linescan measurement.
 
@@ -145,43 +530,352 @@ class LineScan(object):
             step_um (float): Micron step size
             nsteps (int): Number of steps. Num measurements is nsteps + 1.
             moveaxis (int): Motion controller axis to move
+            pipelined (bool): If true, analyse each point on a worker
+                thread while the stage moves to the next one. Not with
+                adaptive acquisition (SdrInterface.set_adaptive), which 
+                needs each spectrum before moving on.
+            n_workers (int): Number of analysis threads when pipelined.
+            autosave (str): If given, directory to append each point to
+                as it is measured (see sdr_storage).
+            resume (bool): If true, continue the interrupted scan saved
+                in autosave instead of starting over. The stage must be 
+                back at the start of the scan (it returns there even if 
+                the scan fails).
+            callback (function): called as callback(row) with a dict of
+                each point as it is measured, e.g. to update a plot.
 
         For now, assume that the FuncGen is already setup with proper
         parameters and SdrInterface is already setup properly.
         """
+        locs = step_um * np.arange(nsteps + 1)
+        self.autosave = autosave
+        self._abort.clear()
+        # Drop times left over from before the run
+        self.sdr.timer.collect()
+        table = ResultTable(self.cols + self.peak_columns() 
+                            + self.timing_columns(), len(locs),
+                            autosave, resume, callback=callback)
+        # Index of the point the stage is at
+        self._pos = 0
+        try:
+            if pipelined and self.sdr.target_snr is None:
+                self._scan_pipelined(locs, step_um, moveaxis, table, 
+                                     n_workers)
+            else:
+                self._scan(locs, step_um, moveaxis, table)
+        finally:
+            table.close()
+            self.sdr.tag_captures()
+            # Return to starting postion
+            if self._pos != 0:
+                self.mc.move_um(moveaxis, -step_um * self._pos)
+                self._pos = 0
+            self.data = table.to_dataframe()
+            self.report_timing()
 
-        data = []
-
-        # Take first point
-        self.sdr.get_spectrum()
-        d33, speed, disp = self.sdr.get_d33_spe_disp()
-        peakratios = self.sdr.peak_ratios()
-        data.append([0.0, d33, speed, disp, *peakratios])
+    def _move_to(self, i, step_um, moveaxis):
+        """Move the stage to point i."""
+        if i != self._pos:
+            with self.sdr.timer.stage('move'):
+                self.mc.move_um(moveaxis, step_um * (i - self._pos))
+                self.sdr.discard_samples()
+            self._pos = i
 
-        # Loop through rest of points
-        for i in range(nsteps):
+    def _scan(self, locs, step_um, moveaxis, table):
+        """Measure the points from table.n_rows on into table."""
+        timer = self.sdr.timer
+        for i in range(table.n_rows, len(locs)):
+            self.check_abort()
+            start = time.perf_counter()
             # Move
-            self.mc.move_um(moveaxis, step_um)
-            loc = (i + 1) * step_um
+            self._move_to(i, step_um, moveaxis)
+            self.sdr.tag_captures(loc_um=locs[i])
 
             # Measure
             self.sdr.get_spectrum()
-            d33, speed, disp = self.sdr.get_d33_spe_disp()
-            peakratios = self.sdr.peak_ratios()
-            data.append([loc, d33, speed, disp, *peakratios])
+            with timer.stage('d33'):
+                d33, speed, disp = self.sdr.get_d33_spe_disp()
+                peakratios = self.sdr.peak_ratios()
+                _, d33_sem, _, ratios_sem = self.sdr.get_statistics()
+            table.append([locs[i], d33, speed, disp, *peakratios, 
+                          d33_sem, *ratios_sem,
+                          *self.point_times(timer.collect(), start)])
+
+    def _scan_pipelined(self, locs, step_um, moveaxis, table, n_workers):
+        """
+        _scan, but only the raw captures are taken at each position and 
+        the analysis runs on a thread pool. scipy.fft and numpy release the
+        GIL, and the sdr (with its USB handle) can't be sent to another 
+        process, so threads rather than processes.
+
+        The timed total of a point is its time on the scan thread (moving
+        and capturing), the fft and peaks stages are on the analysis 
+        thread, overlapping the next points.
+        """
+        pending = {}
+        timer = self.sdr.timer
+        
+        def analyse(captures, times):
+            """analyse_captures, adding the stage times of the analysis 
+            thread to times."""
+            analysis, stats = self.sdr.analyse_captures(captures)
+            times.update(timer.collect())
+            return analysis, stats, times
+
+        def store_done(block=False):
+            """Add finished points to table, in scan order."""
+            i = table.n_rows
+            while i in pending and (block or pending[i].done()):
+                analysis, stats, times = pending.pop(i).result()
+                _, d33_sem, _, ratios_sem = stats
+                table.append([locs[i], analysis.total_d33, analysis.speed[0],
+                              analysis.displacement[0], *analysis.ratios,
+                              d33_sem, *ratios_sem,
+                              *point_times(timer, self.stages, times)])
+                i += 1
+
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            try:
+                for i in range(table.n_rows, len(locs)):
+                    self.check_abort()
+                    start = time.perf_counter()
+                    self._move_to(i, step_um, moveaxis)
+                    self.sdr.tag_captures(loc_um=locs[i])
+                    # Don't let raw captures pile up if analysis is slower
+                    if len(pending) >= 2 * n_workers:
+                        pending[table.n_rows].result()
+                    store_done()
+                    captures = self.sdr.get_captures()
+                    times = timer.collect()
+                    times['total'] = time.perf_counter() - start
+                    pending[i] = pool.submit(analyse, captures, times)
+            finally:
+                # Return to starting postion while the last points finish
+                # (also when aborted, so they aren't lost)
+                self._move_to(0, step_um, moveaxis)
+                store_done(block=True)
+
+
+class AreaScan(Measurement):
+    def __init__(self, sdr, fg, mc):
+        """
+        Do a 2D raster scan sdr measurement (a d33 map)
 
-        # Return to starting postion
-        self.mc.move_um(moveaxis, -step_um * nsteps)
+        Args:
+            sdr (SdrInterface)
+            fg (FuncGen)
+            mc (MotionController)
+        """
+        Measurement.__init__(self, sdr, ['x_um', 'y_um', 'd33', 'speed', 
+                                         'disp'])
+        self.mc = mc
+        self.fg = fg
+        self.maps = {}
+        self.x_um = np.array([])
+        self.y_um = np.array([])
 
-        peakcols = ['peak%d' % (i + 1) for i in range(self.sdr.max_order)]
-        self.data = data
-        outdf = pd.DataFrame(data=np.array(data), columns=self.cols + peakcols)
-        self.data = outdf
+    def quantities(self):
+        """Names of the mapped quantities, in column order."""
+        return ['d33', 'speed', 'disp'] + self.peak_columns()
+
+    def serpentine(self, nx, ny):
+        """
+        (row, col) grid indices in serpentine order: left to right on even
+        rows, right to left on odd rows, so the stage never flies back.
+        """
+        order = []
+        for row in range(ny + 1):
+            cols = range(nx + 1) if row % 2 == 0 else range(nx, -1, -1)
+            order += [(row, col) for col in cols]
+        return order
+
+    def run(self, step_um, nsteps, axes=(2, 1), pipelined=False, 
+            n_workers=2, callback=None, autosave=None, resume=False):
+        """
+        Run an area scan measurement, starting from the current position.
+
+        Args:
+            step_um (tuple): Micron step sizes (fast axis, slow axis)
+            nsteps (tuple): Number of steps (fast axis, slow axis). Num
+                measurements is (nsteps[0] + 1) * (nsteps[1] + 1).
+            axes (tuple): Motion controller axes (fast, slow). Default x
+                (2) is fast and y (1) is slow.
+            pipelined (bool): If true, analyse each point on a worker
+                thread while the stage moves to the next one. Not with
+                adaptive acquisition (SdrInterface.set_adaptive), which 
+                needs each spectrum before moving on.
+            n_workers (int): Number of analysis threads when pipelined.
+            callback (function): called as callback(row, col) once each
+                point is in self.maps, e.g. to update a plot.
+            autosave (str): If given, directory to append each point to
+                as it is measured (see sdr_storage).
+            resume (bool): If true, skip the points already saved in 
+                autosave. The stage must be back at the start of the scan
+                (it returns there even if the scan fails).
+
+        Results go straight into the preallocated 2D arrays in self.maps
+        (nan until measured), indexed [row, col] i.e. [y, x].
+        """
+        nx, ny = nsteps
+        self.x_um = step_um[0] * np.arange(nx + 1)
+        self.y_um = step_um[1] * np.arange(ny + 1)
+        self.maps = {q: np.full((ny + 1, nx + 1), np.nan) 
+                     for q in self.quantities()}
+        columns = self.cols[:2] + self.quantities()
+        self.autosave = autosave
+        self._abort.clear()
+        writer = None
+        done = set()
+        if autosave is not None:
+            if resume and os.path.exists(autosave):
+                # Put the saved points back on the grid
+                for x, y, *values in load_results(autosave).values:
+                    row = int(round(y / step_um[1])) if ny else 0
+                    col = int(round(x / step_um[0])) if nx else 0
+                    for q, value in zip(self.quantities(), values):
+                        self.maps[q][row, col] = value
+                    done.add((row, col))
+            writer = ResultWriter(autosave, columns, overwrite=not resume)
+        lock = threading.Lock()
+
+        def store(row, col, analysis, stats):
+            _, d33_sem, _, ratios_sem = stats
+            values = [analysis.total_d33, analysis.speed[0], 
+                      analysis.displacement[0], *analysis.ratios, 
+                      d33_sem, *ratios_sem]
+            # Called from the analysis threads when pipelined
+            with lock:
+                for q, value in zip(self.quantities(), values):
+                    self.maps[q][row, col] = value
+                if writer is not None:
+                    writer.append([self.x_um[col], self.y_um[row], *values])
+            if callback is not None:
+                callback(row, col)
+
+        todo = [p for p in self.serpentine(nx, ny) if p not in done]
+        pipelined = pipelined and self.sdr.target_snr is None
+        self._pos = (0, 0)
+        try:
+            self._scan(todo, step_um, axes, pipelined, n_workers, store)
+        finally:
+            if writer is not None:
+                writer.close()
+            self.sdr.tag_captures()
+            # Return to starting postion
+            pos = self._pos
+            if pos[1] != 0:
+                self.mc.move_um(axes[0], -pos[1] * step_um[0])
+            if pos[0] != 0:
+                self.mc.move_um(axes[1], -pos[0] * step_um[1])
+            self._pos = (0, 0)
+            self.flatten()
+
+    def flatten(self):
+        """Flat table (one row per point) of the maps in self.data, for 
+        saving like the other scans."""
+        import pandas as pd
+        y, x = np.meshgrid(self.y_um, self.x_um, indexing='ij')
+        columns = [x.ravel(), y.ravel()] + [self.maps[q].ravel() 
+                                            for q in self.quantities()]
+        self.data = pd.DataFrame(data=np.column_stack(columns), 
+                                 columns=self.cols[:2] + self.quantities())
+
+    def _scan(self, points, step_um, axes, pipelined, n_workers, store):
+        """Move to and measure each (row, col) in points, in order."""
+        pending = []
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            for i, (row, col) in enumerate(points):
+                self.check_abort()
+                # Move
+                pos = self._pos
+                if col != pos[1]:
+                    self.mc.move_um(axes[0], (col - pos[1]) * step_um[0])
+                if row != pos[0]:
+                    self.mc.move_um(axes[1], (row - pos[0]) * step_um[1])
+                self._pos = (row, col)
+                self.sdr.discard_samples()
+                self.sdr.tag_captures(x_um=self.x_um[col], 
+                                      y_um=self.y_um[row])
+
+                # Measure
+                if not pipelined:
+                    self.sdr.get_spectrum()
+                    store(row, col, self.sdr.get_analysis(), 
+                          self.sdr.get_statistics())
+                    continue
+                # Don't let raw captures pile up if analysis is slower
+                if i >= 2 * n_workers:
+                    pending[i - 2 * n_workers].result()
+                future = pool.submit(self.sdr.analyse_captures, 
+                                     self.sdr.get_captures())
+                future.add_done_callback(
+                        lambda f, row=row, col=col: store(row, col, 
+                                                          *f.result()))
+                pending.append(future)
+            for future in pending:
+                future.result()
+
+
+class MeasurementRunner(object):
+    """
+    Runs measurements on a worker thread, so the GUI doesn't freeze. The
+    points are posted to self.events as ('point', args of the run's 
+    callback) as they are measured, then one of ('done', None), 
+    ('aborted', None) or ('error', exception).
+    """
+    def __init__(self):
+        self.events = queue.Queue()
+        self.thread = None
+        self.measurement = None
+
+    def start(self, measurement, *args, **kwargs):
+        """Start measurement.run(*args, **kwargs) in the background."""
+        if self.running():
+            raise RuntimeError('A measurement is already running')
+        self.measurement = measurement
+        kwargs['callback'] = lambda *point: self.events.put(('point', point))
+        self.thread = threading.Thread(target=self._run, daemon=True,
+                                       args=(measurement.run, args, kwargs))
+        self.thread.start()
+
+    def _run(self, run, args, kwargs):
+        """Worker thread."""
+        try:
+            run(*args, **kwargs)
+        except MeasurementAborted:
+            self.events.put(('aborted', None))
+        except Exception as e:
+            self.events.put(('error', e))
+        else:
+            self.events.put(('done', None))
+
+    def running(self):
+        """Whether a measurement is running."""
+        return self.thread is not None and self.thread.is_alive()
+
+    def abort(self):
+        """Abort the running measurement, see Measurement.abort."""
+        if self.running():
+            self.measurement.abort()
+
+    def poll(self):
+        """Events posted since the last poll, without waiting."""
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
 
 
 if __name__ == '__main__':
-    class SdrMock(object):
-        pass
-    sdr = SdrMock()
-    sdr.max_order = 3
-    bs = BiasSweep(sdr, None)
\ No newline at end of file
+    from sdr_interface import SimulatedSdrInterface
+
+    class FuncGenMock(object):
+        def offset(self, offset_v):
+            pass
+    sdr = SimulatedSdrInterface(40e6, 2.048e6, 2**17, 30e3, 1, 3,
+                                displacement=1e-10, harmonics=(1e-11, 1e-12))
+    bs = BiasSweep(sdr, FuncGenMock())
+    bs.run(bs.triwave(1, 2))
+    print(bs.data)
\ No newline at end of file
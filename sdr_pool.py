@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 20:12:48 2026
+
+@author: rzchlab
+
+Several SDRs (LDV heads, or redundant receivers) driven together. Each
+backend lives in its own worker process, so captures and FFTs run in
+parallel instead of one after the other in one GIL-bound process. Spectra
+and raw captures come back through a shared memory buffer per device;
+only settings and small results are pickled.
+
+    pool = SdrPool([(RtlSdrInterface, dict(device_index=0)),
+                    (RtlSdrInterface, dict(device_index=1))],
+                   40e6, 2.048e6, 2**19, 30e3, 1, 3)
+    linescan = LineScan(pool, fg, mc)
+
+The workers are started with spawn, so scripts creating a pool need the
+usual if __name__ == '__main__' guard.
+"""
+
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import threading
+import numpy as np
+from sdr_interface import SdrInterface, SpectrumAnalysis
+from sdr_timing import NullTimer, StageTimer
+
+
+def _serve(conn, backend, args, kwargs):
+    """
+    Worker process: create the backend and run the commands from conn
+    until 'close'. Each command gets one reply, ('ok', result) or
+    ('error', exception).
+    """
+    sdr = backend(*args, **kwargs)
+    shm = None
+    try:
+        while True:
+            command, *params = conn.recv()
+            if command == 'close':
+                break
+            try:
+                if command == 'attach':
+                    if shm is not None:
+                        shm.close()
+                    # Spawned workers share the main process's resource
+                    # tracker, which unlinks the buffer if it dies
+                    shm = shared_memory.SharedMemory(params[0])
+                    result = None
+                elif command == 'gather':
+                    result = _gather_to(sdr, shm, *params)
+                elif command == 'collect_times':
+                    result = sdr.timer.collect()
+                else:
+                    name, call_args, call_kwargs = params
+                    result = getattr(sdr, name)(*call_args, **call_kwargs)
+            except Exception as e:
+                conn.send(('error', e))
+                continue
+            conn.send(('ok', result))
+    finally:
+        if shm is not None:
+            shm.close()
+        sdr.close()
+        conn.close()
+
+
+def _gather_to(sdr, shm, name, args, attrs):
+    """
+    Call sdr.name(*args), which returns one array or a sequence of equal
+    length arrays, and write them stacked into shm. Returns the stack's
+    shape and dtype, and the attributes named in attrs.
+    """
+    arrays = np.atleast_2d(np.asarray(getattr(sdr, name)(*args)))
+    if arrays.nbytes > shm.size:
+        raise ValueError('Shared buffer too small for %s' % name)
+    out = np.ndarray(arrays.shape, arrays.dtype, buffer=shm.buf)
+    out[:] = arrays
+    del out
+    return (arrays.shape, arrays.dtype.str,
+            {attr: getattr(sdr, attr) for attr in attrs})
+
+
+class _PoolTimer(StageTimer):
+    """
+    StageTimer of an SdrPool, whose collect adds the stage times of the 
+    devices. They run in parallel, so each stage counts the slowest one.
+    """
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+
+    def collect(self):
+        """This thread's stage times and the devices', starting a new 
+        point."""
+        times = super().collect()
+        slowest = {}
+        for device_times in self.pool._request_all('collect_times'):
+            for name, seconds in device_times.items():
+                slowest[name] = max(slowest.get(name, 0), seconds)
+        for name, seconds in slowest.items():
+            times[name] = times.get(name, 0) + seconds
+        return times
+
+
+def _broadcasting(name):
+    """SdrInterface method name, also run on every device."""
+    def method(self, *args, **kwargs):
+        result = getattr(SdrInterface, name)(self, *args, **kwargs)
+        self._call_all(name, *args, **kwargs)
+        return result
+    method.__name__ = name
+    method.__doc__ = getattr(SdrInterface, name).__doc__
+    return method
+
+
+class SdrPool(SdrInterface):
+    """
+    SdrInterface over several devices, each in a worker process. Use it in
+    place of a single sdr: settings go to every device, and get_spectrum
+    and get_captures trigger all of them at once. The spectrum is the
+    combination of the devices' (see get_spectrum), per device results are
+    in device_analyses.
+    """
+    def __init__(self, devices, center_freq, sample_freq, n_samples,
+                 modulation_freq, ppk_voltage, max_order,
+                 analysis_mode='full'):
+        """
+        Args:
+            devices (list): (backend class, kwargs) of each device, e.g.
+                (RtlSdrInterface, dict(device_index=1)). The backend is
+                created in its worker as backend(center_freq, sample_freq,
+                n_samples, modulation_freq, ppk_voltage, max_order,
+                **kwargs).
+            The rest as for SdrInterface.
+        """
+        context = multiprocessing.get_context('spawn')
+        args = (center_freq, sample_freq, n_samples, modulation_freq,
+                ppk_voltage, max_order)
+        self.connections = []
+        self.processes = []
+        for backend, kwargs in devices:
+            conn, worker_conn = context.Pipe()
+            process = context.Process(target=_serve, daemon=True,
+                                      args=(worker_conn, backend, args,
+                                            kwargs))
+            process.start()
+            self.connections.append(conn)
+            self.processes.append(process)
+        self.buffers = []
+        self._lock = threading.Lock()
+        self.device_magnitude = None
+        self.device_phase = None
+        super().__init__(center_freq, sample_freq, n_samples, modulation_freq,
+             ppk_voltage, max_order, analysis_mode)
+
+    def __len__(self):
+        """Number of devices."""
+        return len(self.connections)
+
+    def _request_all(self, *command):
+        """Send command to every device at once, then wait for all the
+        replies. Raises the first device error, if any."""
+        with self._lock:
+            for conn in self.connections:
+                conn.send(command)
+            replies = [conn.recv() for conn in self.connections]
+        for status, result in replies:
+            if status == 'error':
+                raise result
+        return [result for _, result in replies]
+
+    def _call_all(self, name, *args, **kwargs):
+        """Call method name on every device. Returns their results."""
+        return self._request_all('call', name, args, kwargs)
+
+    def _reserve(self, n_bytes):
+        """Make sure each device's shared buffer holds n_bytes."""
+        if self.buffers and self.buffers[0].size >= n_bytes:
+            return
+        self._release_buffers()
+        self.buffers = [shared_memory.SharedMemory(create=True, size=n_bytes)
+                        for _ in self.connections]
+        with self._lock:
+            for conn, shm in zip(self.connections, self.buffers):
+                conn.send(('attach', shm.name))
+            replies = [conn.recv() for conn in self.connections]
+        for status, result in replies:
+            if status == 'error':
+                raise result
+
+    def _release_buffers(self):
+        """Free the shared buffers."""
+        for shm in self.buffers:
+            shm.close()
+            shm.unlink()
+        self.buffers = []
+
+    def _gather(self, name, *args, attrs=()):
+        """
+        Call method name on every device, which returns arrays through the
+        shared buffers (see _gather_to). Returns a copy of them stacked
+        along a new first axis, and each device's attrs.
+        """
+        replies = self._request_all('gather', name, args, attrs)
+        shape, dtype, _ = replies[0]
+        stack = np.empty((len(self),) + shape, dtype)
+        for out, shm, (shape, dtype, _) in zip(stack, self.buffers, replies):
+            if out.shape != shape:
+                raise ValueError('Devices returned different shapes')
+            view = np.ndarray(shape, dtype, buffer=shm.buf)
+            out[:] = view
+            del view
+        return stack, [info for _, _, info in replies]
+
+    set_center_freq = _broadcasting('set_center_freq')
+    set_sample_freq = _broadcasting('set_sample_freq')
+    set_n_samples = _broadcasting('set_n_samples')
+    set_modulation_freq = _broadcasting('set_modulation_freq')
+    set_voltage = _broadcasting('set_voltage')
+    set_max_order = _broadcasting('set_max_order')
+    set_analysis_mode = _broadcasting('set_analysis_mode')
+    set_averaging = _broadcasting('set_averaging')
+    set_fft_options = _broadcasting('set_fft_options')
+    set_decimation = _broadcasting('set_decimation')
+    set_peak_estimation = _broadcasting('set_peak_estimation')
+    discard_samples = _broadcasting('discard_samples')
+    tag_captures = _broadcasting('tag_captures')
+
+    def set_gain_level(self, gain_level):
+        """Set the gain level of every device."""
+        self.gain_level = gain_level
+        self._call_all('set_gain_level', gain_level)
+        pass
+
+    def set_timing(self, enabled):
+        """Time the stages of each point here and on every device (see 
+        SdrInterface.set_timing). The devices' times come with 
+        timer.collect."""
+        self.timer = _PoolTimer(self) if enabled else NullTimer()
+        self._call_all('set_timing', enabled)
+        pass
+
+    def set_adaptive(self, target_snr, min_samples=2**15, orders=None):
+        """Adaptive acquisition would give each device its own capture
+        length, so only None (off) is supported."""
+        if target_snr is not None:
+            raise ValueError('SdrPool does not support adaptive acquisition')
+        super().set_adaptive(None, min_samples, orders)
+
+    def start_recording(self, path, overwrite=True):
+        """Record each device's raw IQ to path/dev<i> (see
+        SdrInterface.start_recording)."""
+        with self._lock:
+            for i, conn in enumerate(self.connections):
+                conn.send(('call', 'start_recording',
+                           (os.path.join(path, 'dev%d' % i), overwrite), {}))
+            replies = [conn.recv() for conn in self.connections]
+        for status, result in replies:
+            if status == 'error':
+                raise result
+
+    def stop_recording(self):
+        """Stop recording on every device."""
+        self._call_all('stop_recording')
+        pass
+
+    def get_spectrum(self, subtract_bg=False):
+        """
+        Take a spectrum on every device at once (see
+        SdrInterface.get_spectrum) and combine them: the magnitude is the
+        mean over the devices, the phase that of the first device, and
+        get_statistics is over the spectra of all the devices. Returns
+        freqs, magnitude, phase.
+        """
+        return self._combine('get_spectrum', subtract_bg)
+
+    def compute_spectrum(self, subtract_bg=False, full=True):
+        """Recompute the spectrum of each device's last capture (see
+        SdrInterface.compute_spectrum) and combine them as get_spectrum."""
+        return self._combine('compute_spectrum', subtract_bg, full)
+
+    def _combine(self, name, subtract_bg, *args):
+        """Gather freqs, magnitude, phase from method name on every device
+        and store their combination as the current spectrum."""
+        self._reserve(3 * self.n_samples * np.dtype(float).itemsize)
+        spectra, infos = self._gather(name, subtract_bg, *args,
+                                      attrs=('bin_indices', 'ratio_samples'))
+        self.device_magnitude = spectra[:, 1]
+        self.device_phase = spectra[:, 2]
+        self.set_spectrum(spectra[0, 0], None, infos[0]['bin_indices'],
+                          magnitude=self.device_magnitude.mean(axis=0),
+                          phase=self.device_phase[0])
+        # The devices subtracted their own backgrounds
+        self.subtract_bg = subtract_bg
+        ratio_samples = [info['ratio_samples'] for info in infos]
+        if any(samples is None for samples in ratio_samples):
+            ratio_samples = [[analysis.ratios]
+                             for analysis in self.device_analyses()]
+        self.ratio_samples = np.concatenate(ratio_samples)
+        return self.freqs, self.magnitude, self.phase
+
+    def device_analyses(self):
+        """SpectrumAnalysis of each device's last spectrum, at the peaks of
+        the combined spectrum."""
+        analysis = self.get_analysis()
+        return [SpectrumAnalysis(self, analysis.key, analysis.peaks,
+                                 magnitude, phase)
+                for magnitude, phase in zip(self.device_magnitude,
+                                            self.device_phase)]
+
+    def get_bg_spectrum(self):
+        """Collect a background spectrum on every device (they subtract
+        their own). Stores and returns the mean as self.bg_magnitude."""
+        self._reserve(self.n_samples * np.dtype(float).itemsize)
+        bg, _ = self._gather('get_bg_spectrum')
+        self.bg_magnitude = bg[:, 0].mean(axis=0)
+        return self.bg_magnitude
+
+    def get_captures(self):
+        """
+        Raw captures for one point from every device at once, device by
+        device, so analyse_captures averages over all of them.
+        """
+        n_captures = 1
+        if self.average_mode == 'captures':
+            n_captures = self.n_averages
+        self._reserve(n_captures * self.n_samples
+                      * np.dtype(complex).itemsize)
+        captures, _ = self._gather('get_captures')
+        return list(captures.reshape(-1, captures.shape[-1]))
+
+    def close(self):
+        """Close every device and stop the workers."""
+        with self._lock:
+            for conn in self.connections:
+                conn.send(('close',))
+            for process in self.processes:
+                process.join()
+            for conn in self.connections:
+                conn.close()
+        self.connections = []
+        self.processes = []
+        self._release_buffers()
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 14:02:11 2026
+
+@author: rzchlab
+
+Crash safe storage for measurement results. A result store is a directory
+with columns.json (column names and metadata) and one raw little endian
+float64 file per column, appended to point by point. Every row is flushed
+to the OS, so a crash of the program loses nothing, while a power loss can
+lose the rows since the last fsync (see ResultWriter). A partial row left
+behind is dropped when the store is read or reopened.
+
+Raw IQ recordings (IqRecorder) are a directory with all captures in one
+complex64 file, read back through a memory map, and a json lines index of
+where each capture starts and the settings it was taken with.
+"""
+
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+DTYPE = np.dtype('<f8')
+INDEX_FILE = 'columns.json'
+
+
+def column_file(path, column):
+    """File holding one column of the store at path."""
+    return os.path.join(path, column + '.f8')
+
+
+def read_index(path):
+    """Column names and metadata of the store at path."""
+    with open(os.path.join(path, INDEX_FILE)) as f:
+        return json.load(f)
+
+
+def count_rows(path):
+    """Number of complete rows in the store at path."""
+    columns = read_index(path)['columns']
+    sizes = [os.path.getsize(column_file(path, c)) if
+             os.path.exists(column_file(path, c)) else 0 for c in columns]
+    return min(sizes) // DTYPE.itemsize
+
+
+def load_results(path):
+    """Read the store at path into a DataFrame (complete rows only)."""
+    columns = read_index(path)['columns']
+    n_rows = count_rows(path)
+    data = {c: np.fromfile(column_file(path, c), dtype=DTYPE, count=n_rows)
+            for c in columns}
+    import pandas as pd
+    return pd.DataFrame(data, columns=columns)
+
+
+def save_results(path, df, meta=None):
+    """Write a whole DataFrame as a store at path, one column at a time."""
+    with ResultWriter(path, list(df.columns), meta=meta) as writer:
+        writer.append_columns(df.values)
+
+
+class ResultWriter(object):
+    def __init__(self, path, columns, sync_every=50, sync_interval=10.,
+                 meta=None, overwrite=False):
+        """
+        Append rows to the store at path, creating it if needed.
+
+        Args:
+            path (str): store directory
+            columns (list): column names
+            sync_every (int): rows between fsyncs to disk. Each row is 
+                flushed to the OS as it is appended.
+            sync_interval (float): also fsync when this many seconds
+                have passed since the last one
+            meta (dict): saved in columns.json, e.g. the sweep parameters
+            overwrite (bool): if true, delete any existing store first,
+                otherwise append to it (columns must match)
+        """
+        if overwrite and os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.columns = list(columns)
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        if os.path.exists(os.path.join(path, INDEX_FILE)):
+            if read_index(path)['columns'] != self.columns:
+                raise ValueError('Columns of %s do not match' % path)
+        else:
+            with open(os.path.join(path, INDEX_FILE), 'w') as f:
+                json.dump(dict(columns=self.columns, meta=meta or {}), f,
+                          indent=1)
+        # Drop a partial row left by a crash
+        n_bytes = count_rows(path) * DTYPE.itemsize
+        self.files = []
+        for column in self.columns:
+            f = open(column_file(path, column), 'ab')
+            f.truncate(n_bytes)
+            self.files.append(f)
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def append(self, row):
+        """Append one row of values, one per column."""
+        for f, value in zip(self.files, np.asarray(row, dtype=DTYPE)):
+            f.write(value.tobytes())
+        self.flush()
+        self._unsynced += 1
+        if (self._unsynced >= self.sync_every or time.monotonic() 
+                - self._last_sync >= self.sync_interval):
+            self.sync()
+
+    def append_columns(self, values):
+        """Append a 2D array of rows in one write per column."""
+        values = np.asarray(values, dtype=DTYPE)
+        for f, column in zip(self.files, values.T):
+            f.write(np.ascontiguousarray(column).tobytes())
+        self.flush()
+        self.sync()
+
+    def flush(self):
+        """Push appended rows to the OS."""
+        for f in self.files:
+            f.flush()
+
+    def sync(self):
+        """Push appended rows to disk (fsync)."""
+        self.flush()
+        for f in self.files:
+            os.fsync(f.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        """Sync and close the column files."""
+        if not self.files:
+            return
+        self.sync()
+        for f in self.files:
+            f.close()
+        self.files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ResultTable(object):
+    def __init__(self, columns, n_rows, autosave=None, resume=False,
+                 sync_every=50, meta=None, callback=None):
+        """
+        Preallocated float64 accumulator for measurement rows, optionally
+        appending every row to a store on disk as it comes in.
+
+        Args:
+            columns (list): column names
+            n_rows (int): rows to preallocate (points in the measurement)
+            autosave (str): store directory, or None to keep in memory only
+            resume (bool): if true, start from the rows already in the
+                autosave store (n_rows tells the measurement where to pick
+                up), otherwise overwrite it
+            sync_every (int): rows between fsyncs to disk (see 
+                ResultWriter)
+            meta (dict): saved with the store
+            callback (function): called as callback(row) with a dict of
+                each appended row
+        """
+        self.columns = list(columns)
+        self.callback = callback
+        self.values = np.full((n_rows, len(self.columns)), np.nan)
+        self.n_rows = 0
+        self.writer = None
+        if autosave is None:
+            return
+        if resume and os.path.exists(os.path.join(autosave, INDEX_FILE)):
+            previous = load_results(autosave).values[:n_rows]
+            self.values[:len(previous)] = previous
+            self.n_rows = len(previous)
+        self.writer = ResultWriter(autosave, self.columns, sync_every,
+                                   meta=meta, overwrite=not resume)
+
+    def append(self, row):
+        """Add a row (and write it to the store)."""
+        self.values[self.n_rows] = row
+        self.n_rows += 1
+        if self.writer is not None:
+            self.writer.append(row)
+        if self.callback is not None:
+            self.callback(dict(zip(self.columns, row)))
+
+    def close(self):
+        """Close the store, if any."""
+        if self.writer is not None:
+            self.writer.close()
+
+    def to_dataframe(self):
+        """Rows so far as a DataFrame."""
+        import pandas as pd
+        return pd.DataFrame(data=self.values[:self.n_rows].copy(),
+                            columns=self.columns)
+
+
+IQ_DTYPE = np.dtype('<c8')
+IQ_FILE = 'iq.c8'
+IQ_INDEX_FILE = 'index.jsonl'
+
+
+def read_iq_index(path):
+    """Metadata of every capture in the IQ recording at path, in order."""
+    with open(os.path.join(path, IQ_INDEX_FILE)) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def open_iq(path):
+    """Read only memory map of all the samples in the IQ recording at path.
+    Slice it with the offset and n_samples of each capture."""
+    return np.memmap(os.path.join(path, IQ_FILE), dtype=IQ_DTYPE, mode='r')
+
+
+class IqRecorder(object):
+    def __init__(self, path, overwrite=False):
+        """
+        Record raw IQ captures to path/iq.c8 (complex64, one capture after
+        the other) with one line of json metadata per capture in 
+        path/index.jsonl. The dongle samples are 8 bit, so complex64 loses
+        nothing.
+
+        Args:
+            path (str): recording directory
+            overwrite (bool): if true, delete any existing recording,
+                otherwise append to it
+        """
+        if overwrite and os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.iq_file = open(os.path.join(path, IQ_FILE), 'ab')
+        self.index_file = open(os.path.join(path, IQ_INDEX_FILE), 'a')
+        self.offset = self.iq_file.tell() // IQ_DTYPE.itemsize
+
+    def record(self, time_series, meta):
+        """Append a capture and its metadata (a json-able dict)."""
+        np.asarray(time_series, dtype=IQ_DTYPE).tofile(self.iq_file)
+        self.iq_file.flush()
+        entry = dict(offset=self.offset, n_samples=len(time_series), **meta)
+        # default: numpy scalars (e.g. bias points) -> python numbers
+        self.index_file.write(json.dumps(entry, default=lambda x: x.item())
+                              + '\n')
+        self.index_file.flush()
+        self.offset += len(time_series)
+
+    def close(self):
+        """Close the recording files."""
+        self.iq_file.close()
+        self.index_file.close()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 21:03:26 2026
+
+@author: rzchlab
+
+Per stage timing of measurement points (settling, sample I/O, FFT, peak
+search, ...). Turn it on with SdrInterface.set_timing(True); the
+measurements then add a t_<stage> column (seconds) per stage to their data
+and a percentile summary in their timing attribute after each run. Off,
+the timer is a NullTimer whose stages do nothing. The summary is also
+saved in the run's result store (TIMING_FILE) and shown by the GUI.
+"""
+
+import contextlib
+import os
+import threading
+import time
+import numpy as np
+
+# Stages timed inside SdrInterface
+SDR_STAGES = ('samples', 'decimate', 'fft', 'peaks')
+# File the timing report of a run is saved to, in its result store
+TIMING_FILE = 'timing.tsv'
+
+
+class _Stage(object):
+    """
+    Context manager adding its duration to a stage of a timer, less the
+    time of any stages nested in it, so the stages of a point add up to at
+    most its total.
+    """
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.nested = 0
+        self.timer.stack().append(self)
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        stack = self.timer.stack()
+        stack.pop()
+        if stack:
+            stack[-1].nested += elapsed
+        self.timer.add(self.name, elapsed - self.nested)
+
+
+class StageTimer(object):
+    """
+    Accumulates time per stage for the current point, separately for each
+    thread (so pipelined analysis threads don't mix up their points).
+    """
+    enabled = True
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def stage(self, name):
+        """Context manager timing a stage, e.g. with timer.stage('fft'):"""
+        return _Stage(self, name)
+
+    def add(self, name, seconds):
+        """Add seconds to stage name of this thread's current point."""
+        times = self.times()
+        times[name] = times.get(name, 0) + seconds
+
+    def times(self):
+        """This thread's stage times so far, {stage: seconds}."""
+        try:
+            return self._local.times
+        except AttributeError:
+            self._local.times = {}
+            return self._local.times
+
+    def stack(self):
+        """This thread's stages in progress, innermost last."""
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def collect(self):
+        """This thread's stage times, starting a new point."""
+        times = self.times()
+        self._local.times = {}
+        return times
+
+
+class NullTimer(object):
+    """StageTimer that records nothing."""
+    enabled = False
+    _stage = contextlib.nullcontext()
+
+    def stage(self, name):
+        return self._stage
+
+    def add(self, name, seconds):
+        pass
+
+    def collect(self):
+        return {}
+
+
+def timing_columns(timer, stages):
+    """Result columns for stages, if timer is on."""
+    if not timer.enabled:
+        return []
+    return ['t_' + stage for stage in stages]
+
+
+def point_times(timer, stages, times):
+    """Values for timing_columns from the {stage: seconds} of a point
+    (e.g. from timer.collect). Stages that didn't run are nan."""
+    if not timer.enabled:
+        return []
+    return [times.get(stage, np.nan) for stage in stages]
+
+
+def save_timing_report(report, path):
+    """Write a timing_report to TIMING_FILE in the directory path."""
+    report.to_csv(os.path.join(path, TIMING_FILE), sep='\t', 
+                  float_format='%.6e')
+
+
+def timing_report(data, percentiles=(50, 90, 99)):
+    """
+    Summary of the t_<stage> columns of a measurement's data: percentiles,
+    mean and sum (s) of each stage and its share of the summed 'total'
+    (the whole point, untimed bits included). None if there are no 
+    timing columns.
+    """
+    import pandas as pd
+    columns = [c for c in data.columns if c.startswith('t_')]
+    times = data[columns].dropna(axis=1, how='all')
+    if times.empty:
+        return None
+    report = pd.DataFrame(
+            {'p%d' % p: np.nanpercentile(times, p, axis=0)
+             for p in percentiles}, index=[c[2:] for c in times.columns])
+    report['mean'] = times.mean().values
+    report['sum'] = times.sum().values
+    if 't_total' in times:
+        report['share'] = report['sum'] / times['t_total'].sum()
+    return report